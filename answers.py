@@ -0,0 +1,115 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+import numpy as np
+from telemetry import metrics
+from tools import ADDRESS_PATTERN, normalize
+
+
+# Queries about data that changes from one minute to the next are never answered from the cache
+VOLATILE_PATTERN = re.compile(r"\b(price|prices|balance|balances|now|today|current|currently|live|real[- ]time)\b", re.IGNORECASE)
+
+
+class AnswerCache:
+    """
+    Semantic cache of the answers to questions that need no function call.
+    An answer is reused for a query whose embedding is at least similarity_threshold similar to the query it answered.
+    The embeddings are kept normalized in one matrix, so a lookup is a single matrix-vector product.
+    Queries with addresses or about volatile data (see VOLATILE_PATTERN) are never cached.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 600, similarity_threshold: float = 0.92, volatile_pattern: re.Pattern = VOLATILE_PATTERN):
+        """
+        Args:
+            max_size: Maximum number of answers. The least recently used answer is evicted beyond that.
+            ttl: Time-to-live of the answers in seconds.
+            similarity_threshold: Minimum cosine similarity between a query and a cached query to reuse its answer.
+            volatile_pattern: Queries matching this pattern are never cached.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.volatile_pattern = volatile_pattern
+        self.hits = 0
+        self.misses = 0
+        self._matrix: Optional[np.ndarray] = None # (max_size, dim) normalized query embeddings
+        self._valid = np.zeros(max_size, dtype=bool) # rows in use
+        self._entries: Dict[int, tuple] = {} # row -> (query, answer, expiry time)
+        self._rows: "OrderedDict[str, int]" = OrderedDict() # query -> row, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def is_cacheable(self, query: str) -> bool:
+        """
+        Check if the answer to a query may be cached: no address and no volatile data.
+        """
+        return ADDRESS_PATTERN.search(query) is None and self.volatile_pattern.search(query) is None
+
+    def get(self, query_embedding: np.ndarray) -> Optional[str]:
+        """
+        Get the answer of the most similar cached query, or None if there is none above the similarity threshold.
+        """
+        with self._lock:
+            if not self._rows:
+                self.misses += 1
+                return None
+            scores = self._matrix @ normalize(query_embedding)
+            scores[~self._valid] = -np.inf
+            row = int(np.argmax(scores))
+            if scores[row] >= self.similarity_threshold:
+                query, answer, expiry = self._entries[row]
+                if expiry > time.monotonic():
+                    self._rows.move_to_end(query)
+                    self.hits += 1
+                    metrics.inc("answer_cache_hits_total")
+                    return answer
+                self._remove(query)
+            self.misses += 1
+            return None
+
+    def set(self, query: str, query_embedding: np.ndarray, answer: str):
+        """
+        Cache the answer to a query.
+        """
+        embedding = normalize(query_embedding).ravel()
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_size, embedding.shape[0]), dtype=np.float32)
+            if query in self._rows:
+                row = self._rows[query]
+                self._rows.move_to_end(query)
+            elif len(self._rows) < self.max_size:
+                row = int(np.flatnonzero(~self._valid)[0])
+                self._rows[query] = row
+            else:
+                _, row = self._rows.popitem(last=False) # evict the least recently used answer
+                self._rows[query] = row
+            self._matrix[row] = embedding
+            self._valid[row] = True
+            self._entries[row] = (query, answer, time.monotonic() + self.ttl)
+
+    def _remove(self, query: str):
+        row = self._rows.pop(query)
+        self._valid[row] = False
+        del self._entries[row]
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._entries.clear()
+            self._valid[:] = False
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Hit/miss counters and hit rate of the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
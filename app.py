@@ -1,27 +1,103 @@
 import os
-from moralis import sol_api
+import threading
 from dotenv import load_dotenv
+from answers import AnswerCache
+from cache import SQLiteCache
+from intents import IntentCache
+from shaping import ResultShaper
 from llm import ToolCallingLLM
+from shared_index import SharedToolIndex
+from telemetry import metrics
+from tools import ToolIndex
 from functions import *
 
 load_dotenv()
 
+# Time-to-live (seconds) of the cached function results
+VOLATILE_TTL = 15 # prices and balances
+ANALYSIS_TTL = 300 # whale analysis
+METADATA_TTL = 3600 # token and NFT metadata
+
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH') # on-disk result cache (in-memory if not set)
+INTENT_CACHE = os.getenv('INTENT_CACHE', '1') == '1' # make the calls of known query templates without the first LLM call
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', '0') == '1' # reuse the answers to similar questions that need no function call
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', 600)) # seconds
+TOOL_INDEX_DTYPE = os.getenv('TOOL_INDEX_DTYPE', 'float32') # storage of the tool embeddings: float32, float16 or int8
+SHARED_INDEX_DIR = os.getenv('SHARED_INDEX_DIR') # tool index memory-mapped by all the worker processes (private to the process if not set)
+
+_shared_llm = None
+_shared_llm_lock = threading.Lock()
+
+def get_shared_llm() -> ToolCallingLLM:
+    """
+    Get the process-wide ToolCallingLLM with all the functions registered.
+    It is built once (client, function registry and tool index) and shared read-only by all the App instances.
+    """
+    global _shared_llm
+    if _shared_llm is None:
+        with _shared_llm_lock:
+            if _shared_llm is None:
+                result_cache = SQLiteCache(RESULT_CACHE_PATH) if RESULT_CACHE_PATH else None
+                intent_cache = IntentCache() if INTENT_CACHE else None
+                answer_cache = AnswerCache(ttl=ANSWER_CACHE_TTL) if ANSWER_CACHE else None
+                tool_index = SharedToolIndex(SHARED_INDEX_DIR, dtype=TOOL_INDEX_DTYPE) if SHARED_INDEX_DIR else ToolIndex(dtype=TOOL_INDEX_DTYPE)
+                llm = ToolCallingLLM(api_key=os.getenv('HYPERBOLIC_XYZ_KEY'), tool_index=tool_index,
+                                     result_cache=result_cache, intent_cache=intent_cache, answer_cache=answer_cache)
+                _register_functions(llm)
+                metrics.register_collector("function_cache", llm.get_cache_stats)
+                metrics.register_collector("query_cache", llm.tool_manager.query_cache.stats)
+                if intent_cache is not None:
+                    metrics.register_collector("intent_cache", intent_cache.stats)
+                if answer_cache is not None:
+                    metrics.register_collector("answer_cache", answer_cache.stats)
+                _shared_llm = llm
+    return _shared_llm
+
 class App:
-    def __init__(self):
-        self.huggingface_api_key = os.getenv('HYPERBOLIC_XYZ_KEY')
-        self.llm = ToolCallingLLM(api_key=self.huggingface_api_key)
-        self._register_functions()
+    """
+    A chat session: its own message history and generation settings on top of the shared LLM.
+    """
+    def __init__(self, llm: ToolCallingLLM = None, temperature: float = 0.6, max_tokens: int = 512):
+        self.llm = llm or get_shared_llm()
+        self.temperature = temperature
+        self.max_tokens = max_tokens
         self.messages = []
     
     def reset(self):
         self.messages = []
 
-    def _register_functions(self):
-        """Register all available functions with the LLM."""
-        self.llm.register_function(
-            func=get_account_balance,
-            description="Get the balance of an account on a given network.",
-            parameters={
+    def get_messages(self):
+        """Return the current message history."""
+        return self.messages
+
+    def add_message(self, message):
+        """Add a new message to the conversation history."""
+        self.messages.append(message)
+
+    def generate_response(self):
+        """Generate a response using the LLM."""
+        return self.llm.generate_response(messages=self.messages, temperature=self.temperature, max_tokens=self.max_tokens)
+
+    async def agenerate_response(self):
+        """Generate a response using the LLM, without blocking the event loop."""
+        return await self.llm.agenerate_response(messages=self.messages, temperature=self.temperature, max_tokens=self.max_tokens)
+
+    def stream_response(self):
+        """Stream the text deltas of the response of the LLM."""
+        return self.llm.stream_response(messages=self.messages, temperature=self.temperature, max_tokens=self.max_tokens)
+
+    def astream_response(self):
+        """Stream the text deltas of the response of the LLM, without blocking the event loop."""
+        return self.llm.astream_response(messages=self.messages, temperature=self.temperature, max_tokens=self.max_tokens)
+
+def _register_functions(llm: ToolCallingLLM):
+    """Register all available functions with the LLM."""
+    llm.register_functions([
+        {
+            "func": get_account_balance,
+            "cache_ttl": VOLATILE_TTL,
+            "description": "Get the balance of an account on a given network.",
+            "parameters": {
                 "type": "object", 
                 "properties": {
                     "address": {"type": "string", "description": "Address of the account"},
@@ -29,12 +105,13 @@ class App:
                 },
                 "required": ["address"]
             }
-        )
-
-        self.llm.register_function(
-            func=get_account_nfts,
-            description="Get the NFTs owned by an account on a given network.",
-            parameters={
+        },
+        {
+            "func": get_account_nfts,
+            "result_shaper": ResultShaper(fields=["mint", "name", "symbol", "amount"], max_items=25),
+            "cache_ttl": VOLATILE_TTL,
+            "description": "Get the NFTs owned by an account on a given network.",
+            "parameters": {
                 "type": "object",
                 "properties": {
                     "address": {"type": "string", "description": "Address of the account"},
@@ -42,12 +119,13 @@ class App:
                 },
                 "required": ["address"]
             }
-        )
-
-        self.llm.register_function(
-            func=get_account_portfolio,
-            description="Get the portfolio for a given network and address.",
-            parameters={
+        },
+        {
+            "func": get_account_portfolio,
+            "result_shaper": ResultShaper(fields=["nativeBalance", "tokens.mint", "tokens.name", "tokens.symbol", "tokens.amount", "nfts.mint", "nfts.name", "nfts.symbol", "nfts.amount"], max_items=25, decimals=6),
+            "cache_ttl": VOLATILE_TTL,
+            "description": "Get the portfolio for a given network and address.",
+            "parameters": {
                 "type": "object",
                 "properties": {
                     "address": {"type": "string", "description": "Address of the account"},
@@ -55,12 +133,13 @@ class App:
                 },
                 "required": ["address"]
             }
-        )
-
-        self.llm.register_function(
-            func=get_account_spl,
-            description="Get the token balances owned by a given network and address.",
-            parameters={
+        },
+        {
+            "func": get_account_spl,
+            "result_shaper": ResultShaper(fields=["mint", "name", "symbol", "amount"], max_items=25, decimals=6),
+            "cache_ttl": VOLATILE_TTL,
+            "description": "Get the token balances owned by a given network and address.",
+            "parameters": {
                 "type": "object",
                 "properties": {
                     "address": {"type": "string", "description": "Address of the account"},
@@ -68,12 +147,12 @@ class App:
                 },
                 "required": ["address"]
             }
-        )
-
-        self.llm.register_function(
-            func=get_nft_metadata,
-            description="Get the global NFT metadata for a given network and contract.",
-            parameters={
+        },
+        {
+            "func": get_nft_metadata,
+            "cache_ttl": METADATA_TTL,
+            "description": "Get the global NFT metadata for a given network and contract.",
+            "parameters": {
                 "type": "object",
                 "properties": {
                     "contract_address": {"type": "string", "description": "Address of the NFT contract"},
@@ -81,12 +160,13 @@ class App:
                 },
                 "required": ["contract_address"]
             }
-        )
-
-        self.llm.register_function(
-            func=get_token_price,
-            description="Get the token price (usd and native) for a given contract address and network.",
-            parameters={
+        },
+        {
+            "func": get_token_price,
+            "result_shaper": ResultShaper(decimals=8),
+            "cache_ttl": VOLATILE_TTL,
+            "description": "Get the token price (usd and native) for a given contract address and network.",
+            "parameters": {
                 "type": "object",
                 "properties": {
                     "contract_address": {"type": "string", "description": "Address of the token contract"},
@@ -94,12 +174,12 @@ class App:
                 },
                 "required": ["contract_address"]
             }
-        )
-
-        self.llm.register_function(
-            func=get_token_metadata,
-            description="Get the global token metadata for a given network and contract.",
-            parameters={
+        },
+        {
+            "func": get_token_metadata,
+            "cache_ttl": METADATA_TTL,
+            "description": "Get the global token metadata for a given network and contract.",
+            "parameters": {
                 "type": "object",
                 "properties": {
                     "contract_address": {"type": "string", "description": "Address of the token contract"},
@@ -107,13 +187,51 @@ class App:
                 },
                 "required": ["contract_address"]
             }
-        )
-
-
-        self.llm.register_function(
-            func=get_whale_analysis,
-            description="Analyze whale holders of a token and their potential market impact.",
-            parameters={
+        },
+        {
+            "func": get_account_balances,
+            "cache_ttl": VOLATILE_TTL,
+            "description": "Get the balances of several accounts at once on a given network.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "addresses": {"type": "array", "items": {"type": "string"}, "description": "Addresses of the accounts"},
+                    "network": {"type": "string", "description": "Name of the solana network", "default": "mainnet"}
+                },
+                "required": ["addresses"]
+            }
+        },
+        {
+            "func": get_token_prices,
+            "cache_ttl": VOLATILE_TTL,
+            "description": "Get the token prices (usd and native) of several token contracts at once on a given network.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "contract_addresses": {"type": "array", "items": {"type": "string"}, "description": "Addresses of the token contracts"},
+                    "network": {"type": "string", "description": "Name of the solana network", "default": "mainnet"}
+                },
+                "required": ["contract_addresses"]
+            }
+        },
+        {
+            "func": get_tokens_metadata,
+            "cache_ttl": METADATA_TTL,
+            "description": "Get the global token metadata of several token contracts at once on a given network.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "contract_addresses": {"type": "array", "items": {"type": "string"}, "description": "Addresses of the token contracts"},
+                    "network": {"type": "string", "description": "Name of the solana network", "default": "mainnet"}
+                },
+                "required": ["contract_addresses"]
+            }
+        },
+        {
+            "func": get_whale_analysis,
+            "cache_ttl": ANALYSIS_TTL,
+            "description": "Analyze whale holders of a token and their potential market impact.",
+            "parameters": {
                 "type": "object",
                 "properties": {
                     "token_address": {"type": "string", "description": "Address of the token contract to analyze"},
@@ -125,45 +243,32 @@ class App:
                 },
                 "required": ["token_address", "prompt"]
             }
-        )
-
-        # self.llm.register_function(
-        #     func=search_arxiv_papers,
-        #     description="Search for academic papers on arXiv.",
-        #     parameters={
-        #         "type": "object",
-        #         "properties": {
-        #             "query": {"type": "string", "description": "Search query"},
-        #             "max_results": {"type": "integer", "description": "Maximum number of results"}
-        #         },
-        #         "required": ["query"]
-        #     }
-        # )
-
-        # self.llm.register_function(
-        #     func=get_weather,
-        #     description="Get the current weather for a city.",
-        #     parameters={
-        #         "type": "object",
-        #         "properties": {
-        #             "city": {"type": "string", "description": "Name of the city"}
-        #         },
-        #         "required": ["city"]
-        #     }
-        
-        
-
-    def get_messages(self):
-        """Return the current message history."""
-        return self.messages
+        }
+    ])
 
-    def add_message(self, message):
-        """Add a new message to the conversation history."""
-        self.messages.append(message)
+    # llm.register_function(
+    #     func=search_arxiv_papers,
+    #     description="Search for academic papers on arXiv.",
+    #     parameters={
+    #         "type": "object",
+    #         "properties": {
+    #             "query": {"type": "string", "description": "Search query"},
+    #             "max_results": {"type": "integer", "description": "Maximum number of results"}
+    #         },
+    #         "required": ["query"]
+    #     }
+    # )
 
-    def generate_response(self):
-        """Generate a response using the LLM."""
-        return self.llm.generate_response(messages=self.messages)
+    # llm.register_function(
+    #     func=get_weather,
+    #     description="Get the current weather for a city.",
+    #     parameters={
+    #         "type": "object",
+    #         "properties": {
+    #             "city": {"type": "string", "description": "Name of the city"}
+    #         },
+    #         "required": ["city"]
+    #     }
 
 # Initialize app
 # app = App()
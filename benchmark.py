@@ -0,0 +1,451 @@
+# Offline benchmark of the tool calling pipeline:
+# a local OpenAI-compatible stand-in server, stubbed Moralis functions and synthetic tool catalogs.
+#
+# python benchmark.py --sizes 10 100 1000 --output bench.json --baseline previous_bench.json
+# python benchmark.py --startup-only  (import time of the entry modules against the budget)
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+import numpy as np
+from openai import AsyncOpenAI, OpenAI
+import embeddings
+from context import estimate_tokens
+from llm import ToolCallingLLM
+from tools import IVFToolIndex, ToolIndex, normalize
+
+
+ATTRIBUTES = ["balance", "price", "metadata", "holders", "volume", "supply", "transactions", "swaps", "stakes", "rewards",
+              "liquidity", "fees", "owners", "transfers", "listings", "bids", "royalties", "votes", "delegations", "burns"]
+ENTITIES = ["account", "token", "wallet", "NFT collection", "liquidity pool", "validator", "program", "market",
+            "vault", "mint", "domain", "stake account", "DAO", "bridge", "oracle"]
+QUALIFIERS = ["current", "historical", "daily", "weekly", "total", "average", "latest", "top", "pending", "aggregated"]
+
+SAMPLE_ADDRESS = "So11111111111111111111111111111111111111112"
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_MODULES = ["tools", "llm", "app", "chat"] # entry modules whose import time is profiled
+IMPORT_TIME_BUDGET = 1.0 # seconds to import each of the STARTUP_MODULES in a fresh interpreter
+_IMPORT_TIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+class HashingModel:
+    """
+    Deterministic stand-in for the SentenceTransformer (hashed bag of words), to measure the index
+    and the pipeline without the cost of the embedding model.
+    """
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def encode(self, text, batch_size: int = 32):
+        texts = [text] if isinstance(text, str) else list(text)
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, item in enumerate(texts):
+            for word in re.findall(r"\w+", item.lower()):
+                bucket = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:4], "little")
+                vectors[row, bucket % self.dim] += 1.0
+        return vectors[0] if isinstance(text, str) else vectors
+
+
+def make_stub_function(name: str, latency: float):
+    """
+    Stub of a Moralis function: sleeps for the upstream latency and returns a small payload.
+    """
+    def stub(address: str, network: str = "mainnet"):
+        time.sleep(latency)
+        return {"address": address, "network": network, "value": 42.123456, "items": [{"id": i} for i in range(5)]}
+    stub.__name__ = name
+    return stub
+
+
+def make_catalog(size: int, latency: float, seed: int = 0) -> List[Dict]:
+    """
+    Generate a synthetic catalog of tools in the format of `ToolCallingLLM.register_functions`.
+    """
+    rng = random.Random(seed)
+    catalog = []
+    for i in range(size):
+        attribute, entity, qualifier = rng.choice(ATTRIBUTES), rng.choice(ENTITIES), rng.choice(QUALIFIERS)
+        name = f"get_{qualifier}_{attribute}_{re.sub(r'[^a-z]+', '_', entity.lower())}_{i}"
+        catalog.append({
+            "func": make_stub_function(name, latency),
+            "description": f"Get the {qualifier} {attribute} of a {entity} on the Solana network",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "address": {"type": "string", "description": f"The address of the {entity}"},
+                    "network": {"type": "string", "description": "The network (mainnet or devnet)", "default": "mainnet"}
+                },
+                "required": ["address"]
+            }
+        })
+    return catalog
+
+
+def make_queries(count: int, seed: int = 1) -> List[str]:
+    """
+    Generate distinct user queries, so that every query misses the query embedding cache.
+    """
+    rng = random.Random(seed)
+    return [
+        f"What is the {rng.choice(QUALIFIERS)} {rng.choice(ATTRIBUTES)} of the {rng.choice(ENTITIES)} {SAMPLE_ADDRESS} (request {i})?"
+        for i in range(count)
+    ]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return float(np.percentile(values, q))
+
+
+def latency_summary(seconds: List[float]) -> Dict[str, float]:
+    milliseconds = [value * 1000 for value in seconds]
+    return {
+        "count": len(milliseconds),
+        "mean_ms": statistics.fmean(milliseconds) if milliseconds else 0.0,
+        "p50_ms": percentile(milliseconds, 50),
+        "p99_ms": percentile(milliseconds, 99),
+    }
+
+
+class FakeLLMServer:
+    """
+    Local OpenAI-compatible chat completions endpoint with a configurable latency.
+    It calls the first offered tool on a user message, and answers with text after a tool result.
+    Streaming (server-sent events) is supported.
+    """
+    def __init__(self, latency: float = 0.05, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                server.requests += 1
+                time.sleep(server.latency)
+                content = server.reply(body)
+                if body.get("stream"):
+                    self._stream(body, content)
+                else:
+                    self._send_json(server.completion(body, content))
+
+            def _send_json(self, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, body, content):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for start in range(0, len(content), 8):
+                    chunk = {
+                        "id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model"),
+                        "choices": [{"index": 0, "delta": {"content": content[start:start + 8]}, "finish_reason": None}]
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://{host}:{self._server.server_address[1]}/v1"
+
+    def reply(self, body: Dict) -> str:
+        messages = body.get("messages", [])
+        tools = body.get("tools") or []
+        if messages and messages[-1]["role"] == "user" and tools:
+            return json.dumps({"name": tools[0]["function"]["name"], "parameters": {"address": SAMPLE_ADDRESS}})
+        return "Here is the answer based on the data returned by the function."
+
+    def completion(self, body: Dict, content: str) -> Dict:
+        prompt_tokens = sum(estimate_tokens(message.get("content") or "") for message in body.get("messages", []))
+        completion_tokens = estimate_tokens(content)
+        return {
+            "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-llm-server", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def build_llm(server: FakeLLMServer, index: str, dtype: str = "float32", max_parallel_tool_calls: int = 8) -> ToolCallingLLM:
+    tool_index = IVFToolIndex(dtype=dtype) if index == "ivf" else ToolIndex(dtype=dtype)
+    llm = ToolCallingLLM(api_key="benchmark", embedding_cache_dir=None, tool_index=tool_index,
+                         max_parallel_tool_calls=max_parallel_tool_calls)
+    if server is not None:
+        llm.client = OpenAI(base_url=server.url, api_key="benchmark")
+        llm.async_client = AsyncOpenAI(base_url=server.url, api_key="benchmark")
+    return llm
+
+
+def bench_catalog(size: int, args) -> Dict:
+    """
+    Registration time, select_tools latency and prompt size for a catalog of the given size.
+    """
+    catalog = make_catalog(size, args.tool_latency, seed=args.seed)
+    llm = build_llm(None, args.index, args.dtype)
+
+    start = time.perf_counter()
+    llm.register_functions(catalog)
+    registration_seconds = time.perf_counter() - start
+
+    queries = make_queries(args.queries, seed=args.seed + 1)
+    llm.tool_manager.select_tools(queries[0]) # warm up
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        llm.tool_manager.select_tools(query)
+        latencies.append(time.perf_counter() - start)
+
+    system_prompt, functions_list = llm._get_system_prompt_with_tools(queries[0])
+    result = {
+        "catalog_size": size,
+        "registration_seconds": registration_seconds,
+        "select_tools": latency_summary(latencies),
+        "prompt": {"chars": len(system_prompt), "estimated_tokens": estimate_tokens(system_prompt), "tools": len(functions_list)},
+        "index_bytes": llm.tool_manager.index.nbytes,
+        "quantization": bench_quantization(llm.tool_manager, queries),
+    }
+    print(f"#### {size} tools: registration {registration_seconds:.2f} s, select_tools p50 {result['select_tools']['p50_ms']:.2f} ms "
+          f"p99 {result['select_tools']['p99_ms']:.2f} ms, prompt {result['prompt']['estimated_tokens']} tokens \n####")
+    return result
+
+
+def bench_quantization(tool_manager, queries: List[str], top_n: int = 5) -> Dict:
+    """
+    Size, recall@top_n and score error of the quantized storages of the tool index against float32,
+    with the scan time of one query.
+    """
+    index = tool_manager.index
+    matrix = index.matrix
+    query_embeddings = [tool_manager.get_query_embedding(query) for query in queries[:50]]
+    exact = ToolIndex()
+    exact.add_many(index.names, matrix)
+    report = {}
+    for dtype in ToolIndex.DTYPES:
+        quantized = ToolIndex(dtype=dtype)
+        quantized.add_many(index.names, matrix)
+        found = expected = 0
+        errors = []
+        latencies = []
+        for query_embedding in query_embeddings:
+            start = time.perf_counter()
+            scores = quantized.scores(query_embedding)
+            latencies.append(time.perf_counter() - start)
+            errors.append(float(np.abs(scores - exact.scores(query_embedding)).max()))
+            # A tool counts as found if its exact score reaches the exact top N (ties are equally good)
+            reference = exact.search(query_embedding, top_n, -np.inf)
+            query_embedding = normalize(query_embedding)
+            found += sum(
+                float(exact.get(name) @ query_embedding) >= reference[-1][1] - 1e-6
+                for name, _ in quantized.search(query_embedding, top_n, -np.inf)
+            )
+            expected += len(reference)
+        report[dtype] = {
+            "bytes": quantized.nbytes,
+            "compression": exact.nbytes / quantized.nbytes if quantized.nbytes else 1.0,
+            f"recall@{top_n}": found / expected if expected else 1.0,
+            "max_score_error": max(errors, default=0.0),
+            "scan": latency_summary(latencies),
+        }
+    return report
+
+
+def bench_end_to_end(args) -> Dict:
+    """
+    Throughput and latency of `generate_response` (one tool call and two LLM calls per turn) under concurrent sessions.
+    """
+    server = FakeLLMServer(latency=args.llm_latency).start()
+    try:
+        catalog = make_catalog(args.e2e_catalog_size, args.tool_latency, seed=args.seed)
+        llm = build_llm(server, args.index, args.dtype)
+        llm.register_functions(catalog)
+        queries = make_queries(args.sessions * args.turns, seed=args.seed + 2)
+
+        def run_session(session: int) -> List[float]:
+            messages = []
+            latencies = []
+            for turn in range(args.turns):
+                messages.append({"role": "user", "content": queries[session * args.turns + turn]})
+                start = time.perf_counter()
+                llm.generate_response(messages)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            latencies = [latency for session in executor.map(run_session, range(args.sessions)) for latency in session]
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+
+    result = {
+        "catalog_size": args.e2e_catalog_size,
+        "sessions": args.sessions,
+        "turns_per_session": args.turns,
+        "llm_latency_seconds": args.llm_latency,
+        "tool_latency_seconds": args.tool_latency,
+        "llm_requests": server.requests,
+        "elapsed_seconds": elapsed,
+        "turns_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "turn": latency_summary(latencies),
+    }
+    print(f"#### End to end: {result['turns_per_second']:.1f} turns/s with {args.sessions} sessions, "
+          f"turn p50 {result['turn']['p50_ms']:.1f} ms p99 {result['turn']['p99_ms']:.1f} ms \n####")
+    return result
+
+
+def profile_import(module: str, top: int = 8) -> Dict:
+    """
+    Import a module in a fresh interpreter with `python -X importtime`:
+    total import time and the packages that take the most time (self time summed by top-level package).
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True, cwd=PACKAGE_DIR)
+    if process.returncode != 0:
+        raise RuntimeError(f"import {module} failed: {process.stderr.strip().splitlines()[-1]}")
+    import_us = 0
+    packages = {}
+    for line in process.stderr.splitlines():
+        match = _IMPORT_TIME_PATTERN.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = int(match.group(1)), int(match.group(2)), match.group(3), match.group(4)
+        if name == module and not indent:
+            import_us = cumulative_us
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        "import_ms": import_us / 1000,
+        "heaviest_packages_ms": {package: self_us / 1000 for package, self_us in heaviest},
+    }
+
+
+def bench_startup(args) -> Dict:
+    """
+    Import time of the entry modules (each in a fresh interpreter) against the import-time budget.
+    """
+    report = {"budget_ms": args.import_budget * 1000, "modules": {}, "over_budget": []}
+    for module in STARTUP_MODULES:
+        profile = profile_import(module)
+        report["modules"][module] = profile
+        if profile["import_ms"] > report["budget_ms"]:
+            report["over_budget"].append(module)
+        heaviest = ", ".join(f"{package} {ms:.0f} ms" for package, ms in profile["heaviest_packages_ms"].items())
+        print(f"#### import {module}: {profile['import_ms']:.0f} ms (budget {report['budget_ms']:.0f} ms), heaviest: {heaviest} \n####")
+    return report
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=PACKAGE_DIR).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(results: Dict, baseline: Dict):
+    """
+    Print the relative change of the main metrics against a previous run (positive = slower/bigger).
+    """
+    previous = {result["catalog_size"]: result for result in baseline.get("catalogs", [])}
+    for result in results["catalogs"]:
+        old = previous.get(result["catalog_size"])
+        if old is None:
+            continue
+        for label, new_value, old_value in [
+            ("registration", result["registration_seconds"], old["registration_seconds"]),
+            ("select_tools p50", result["select_tools"]["p50_ms"], old["select_tools"]["p50_ms"]),
+            ("select_tools p99", result["select_tools"]["p99_ms"], old["select_tools"]["p99_ms"]),
+            ("prompt tokens", result["prompt"]["estimated_tokens"], old["prompt"]["estimated_tokens"]),
+        ]:
+            if old_value:
+                print(f"{result['catalog_size']:>6} tools {label:<18} {old_value:>10.3f} -> {new_value:>10.3f} ({(new_value / old_value - 1) * 100:+.1f}%)")
+    if results.get("end_to_end") and baseline.get("end_to_end"):
+        new_value, old_value = results["end_to_end"]["turns_per_second"], baseline["end_to_end"]["turns_per_second"]
+        if old_value:
+            print(f"end to end turns/s {old_value:>10.3f} -> {new_value:>10.3f} ({(new_value / old_value - 1) * 100:+.1f}%)")
+    if results.get("startup") and baseline.get("startup"):
+        for module, profile in results["startup"]["modules"].items():
+            old = baseline["startup"]["modules"].get(module)
+            if old and old["import_ms"]:
+                new_value, old_value = profile["import_ms"], old["import_ms"]
+                print(f"{'import ' + module + ' ms':<18} {old_value:>10.3f} -> {new_value:>10.3f} ({(new_value / old_value - 1) * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the tool selection and of the tool calling loop.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 50000], help="Catalog sizes to benchmark.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of select_tools queries per catalog.")
+    parser.add_argument("--index", choices=["exact", "ivf"], default="exact", help="Tool index.")
+    parser.add_argument("--dtype", choices=list(ToolIndex.DTYPES), default="float32", help="Storage of the tool embeddings.")
+    parser.add_argument("--hash-embeddings", action="store_true", help="Use a hashing model instead of the SentenceTransformer.")
+    parser.add_argument("--sessions", type=int, default=8, help="Concurrent sessions of the end-to-end benchmark (0 to skip it).")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per session of the end-to-end benchmark.")
+    parser.add_argument("--e2e-catalog-size", type=int, default=100, help="Catalog size of the end-to-end benchmark.")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Latency of the fake LLM endpoint in seconds.")
+    parser.add_argument("--tool-latency", type=float, default=0.02, help="Latency of the stubbed Moralis functions in seconds.")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_TIME_BUDGET, help="Import time budget of each entry module in seconds.")
+    parser.add_argument("--startup-only", action="store_true", help="Only profile the import time of the entry modules.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json", help="File the results are written to (JSON).")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    if args.hash_embeddings:
+        embeddings.model_registry.register(HashingModel())
+    elif not args.startup_only:
+        embeddings.warmup()
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "args": vars(args),
+        },
+        "startup": bench_startup(args),
+        "catalogs": [] if args.startup_only else [bench_catalog(size, args) for size in args.sizes],
+        "end_to_end": bench_end_to_end(args) if args.sessions > 0 and not args.startup_only else None,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"#### Results written to {args.output} \n####")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(results, json.load(f))
+
+    if results["startup"]["over_budget"]:
+        print(f"#### Over the import time budget: {', '.join(results['startup']['over_budget'])} \n####")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
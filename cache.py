@@ -0,0 +1,321 @@
+import functools
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable
+
+try:
+    import fcntl
+except ImportError: # not available on Windows: the file locks then do not protect against concurrent processes
+    fcntl = None
+
+
+_MISSING = object()
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock between processes (and between the threads that each take it), held on a lock file.
+    """
+    with open(path, "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded LRU cache with an optional time-to-live.
+    Keeps hit and miss counters so the hit rate can be monitored.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = None):
+        """
+        Args:
+            max_size: Maximum number of entries. The least recently used entry is evicted beyond that.
+            ttl: Time-to-live of the entries in seconds. Entries never expire if None.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict() # key -> (value, expiry time)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        """
+        Get the value of a key, or default if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self._entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return entry[0]
+            if entry is not None: # expired
+                del self._entries[key]
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        """
+        Set the value of a key. ttl overrides the default time-to-live of the cache.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expiry = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expiry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_set(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Get the value of a key, computing and storing it on a miss.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Hit/miss counters and hit rate of the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class SQLiteCache:
+    """
+    Size-bounded on-disk cache backed by SQLite, with the same interface as LRUCache.
+    Values are stored as JSON, so only JSON-serializable values are cached (the other ones are silently skipped).
+    Keys are converted to strings.
+    """
+    def __init__(self, path: str, max_size: int = 10000, ttl: float = None):
+        """
+        Args:
+            path: Path of the SQLite database file.
+            max_size: Maximum number of entries. The least recently used entries are evicted beyond that.
+            ttl: Default time-to-live of the entries in seconds. Entries never expire if None.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expiry REAL, accessed REAL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        """
+        Get the value of a key, or default if it is missing or expired.
+        """
+        key = str(key)
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT value, expiry FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and (row[1] is None or row[1] > now):
+                self._connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+                if count:
+                    self.hits += 1
+                return json.loads(row[0])
+            if row is not None: # expired
+                self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        """
+        Set the value of a key. ttl overrides the default time-to-live of the cache.
+        """
+        try:
+            serialized = json.dumps(value)
+        except (TypeError, ValueError):
+            return
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expiry = now + ttl if ttl is not None else None
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expiry, accessed) VALUES (?, ?, ?, ?)",
+                (str(key), serialized, expiry, now)
+            )
+            self._connection.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,)
+            )
+
+    def get_or_set(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Get the value of a key, computing and storing it on a miss.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def delete(self, key: Hashable):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache WHERE key = ?", (str(key),))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache")
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Hit/miss counters and hit rate of the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls: while a call for a key is in flight,
+    the other callers for the same key wait for its result instead of starting their own.
+    """
+    def __init__(self):
+        self.coalesced = 0 # number of calls that shared the result of an in-flight call
+        self._calls: Dict[Hashable, dict] = {} # key -> in-flight call
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """
+        Run func for the key, or wait for the result of the in-flight call for the same key.
+        Errors are propagated to all the waiting callers.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["event"].set()
+
+
+class CachedFunction:
+    """
+    Wrap a function with a result cache: results are cached for ttl seconds in a pluggable backend
+    (LRUCache, SQLiteCache...) and concurrent identical calls share a single upstream call.
+    The cache key is the function name with its bound arguments (defaults applied), so equivalent calls share an entry.
+    Errors are never cached.
+    """
+    def __init__(self, func: Callable, ttl: float, backend=None):
+        """
+        Args:
+            func: The function to wrap.
+            ttl: Time-to-live of the results in seconds.
+            backend: The cache backend. Defaults to an in-memory LRUCache.
+        """
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.ttl = ttl
+        self.backend = backend if backend is not None else LRUCache()
+        self.hits = 0
+        self.misses = 0
+        self._signature = inspect.signature(func)
+        self._flight = SingleFlight()
+
+    def _key(self, args, kwargs) -> str:
+        bound = self._signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return f"{self.func.__name__}:{json.dumps(bound.arguments, sort_keys=True, default=str)}"
+
+    def __call__(self, *args, **kwargs):
+        key = self._key(args, kwargs)
+        value = self.backend.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        def compute():
+            result = self.func(*args, **kwargs)
+            self.backend.set(key, result, ttl=self.ttl)
+            return result
+
+        return self._flight.do(key, compute)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Hit/miss counters, hit rate and number of coalesced calls of the function.
+        """
+        total = self.hits + self.misses
+        return {
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self._flight.coalesced,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -1,27 +1,88 @@
 # Gradio chat interface
 
-import gradio as gr
-from app import App
+import embeddings
+from app import App, get_shared_llm
+from cache import SQLiteCache
+from sessions import SessionStore
+from telemetry import metrics, serve_metrics
 from typing import Dict, Any
+import json
+import os
 import uuid
 
+# Session store limits
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', 1000))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', 3600)) # seconds
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', 256 * 1024 * 1024))
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH') # on-disk store of the evicted sessions (not restorable if not set)
+SESSION_DB_TTL = 7 * 24 * 3600 # seconds
+
+# Maximum number of chat turns handled at the same time (unlimited if not set: the handlers are async and only wait on I/O).
+# Gradio runs one event of each listener at a time by default, which would serialize the turns of all the users.
+CHAT_CONCURRENCY_LIMIT = int(os.getenv('CHAT_CONCURRENCY_LIMIT')) if os.getenv('CHAT_CONCURRENCY_LIMIT') else None
+
+# Port of the metrics endpoint (/metrics in Prometheus format, /metrics.json), not served if not set
+METRICS_PORT = os.getenv('METRICS_PORT')
+
+def _create_session() -> Dict[str, Any]:
+    return {
+        "app_instance": App(),  # New session on top of the shared LLM and tool registry
+        "chat_history": []
+    }
+
+def _dump_session(session: Dict[str, Any]) -> Dict:
+    app_instance = session["app_instance"]
+    return {
+        "messages": app_instance.messages,
+        "temperature": app_instance.temperature,
+        "max_tokens": app_instance.max_tokens,
+        "chat_history": session["chat_history"]
+    }
+
+def _load_session(data: Dict) -> Dict[str, Any]:
+    app_instance = App(temperature=data["temperature"], max_tokens=data["max_tokens"])
+    app_instance.messages = data["messages"]
+    return {"app_instance": app_instance, "chat_history": data["chat_history"]}
+
+def _session_size(session: Dict[str, Any]) -> int:
+    """Estimate the memory used by a session from the size of its histories."""
+    return len(json.dumps(session["app_instance"].messages, default=str)) + len(json.dumps(session["chat_history"], default=str))
+
 # Store for managing multiple chat sessions
-sessions: Dict[str, Any] = {}
+sessions = SessionStore(
+    create=_create_session,
+    dump=_dump_session,
+    load=_load_session,
+    size=_session_size,
+    max_sessions=MAX_SESSIONS,
+    idle_ttl=SESSION_IDLE_TTL,
+    max_bytes=SESSION_MAX_BYTES,
+    backend=SQLiteCache(SESSION_DB_PATH, max_size=100 * MAX_SESSIONS, ttl=SESSION_DB_TTL) if SESSION_DB_PATH else None,
+)
 
 def get_or_create_session(session_id: str):
     """
     Get an existing session or create a new one.
     """
-    if session_id not in sessions:
-        sessions[session_id] = {
-            "app_instance": App(),  # Create new App instance for this session
-            "chat_history": []
-        }
-    return sessions[session_id]
+    return sessions.get_or_create(session_id)
 
-def chat_with_llm(user_input: str, session_id: str):
+def format_history(chat_history):
+    """
+    Format the chat history for the Gradio Chatbot: a list of (user message, assistant message) pairs.
+    """
+    formatted_history = []
+    for message in chat_history:
+        if message["role"] == "user":
+            formatted_history.append((message["content"], None))
+        elif message["role"] == "assistant":
+            formatted_history[-1] = (formatted_history[-1][0], message["content"])
+    return formatted_history
+
+async def chat_with_llm(user_input: str, session_id: str):
     """
     Handle user input and generate responses using the ToolCallingLLM.
+    The handler is an async generator: the chatbot is updated as the tokens of the response arrive,
+    and a slow completion or tool call does not hold a worker thread.
     """
     # Get or create session
     session = get_or_create_session(session_id)
@@ -32,9 +93,15 @@ def chat_with_llm(user_input: str, session_id: str):
     user_message = {"role": "user", "content": user_input.strip()}
     chat_history.append(user_message)
     app_instance.add_message(user_message)
-    
-    # Generate the LLM's response
-    response = app_instance.generate_response()
+    formatted_history = format_history(chat_history)
+    yield formatted_history
+
+    # Stream the LLM's response
+    response = ""
+    async for delta in app_instance.astream_response():
+        response += delta
+        formatted_history[-1] = (formatted_history[-1][0], response)
+        yield formatted_history
 
     # Add the assistant's response to the conversation history
     assistant_message = {"role": "assistant", "content": response}
@@ -42,116 +109,136 @@ def chat_with_llm(user_input: str, session_id: str):
     
     # Update the session's chat history
     session["chat_history"] = chat_history
+    sessions.touch(session_id)
 
-    # Format the chat history for Gradio
-    formatted_history = []
-    for message in chat_history:
-        if message["role"] == "user":
-            formatted_history.append((message["content"], None))
-        elif message["role"] == "assistant":
-            formatted_history[-1] = (formatted_history[-1][0], message["content"])
-
-    return formatted_history
-
-def reset_chat(session_id: str):
+async def reset_chat(session_id: str):
     """
     Reset the chat and clear the session.
     """
     session = get_or_create_session(session_id)
     session["app_instance"].reset()
     session["chat_history"] = []
+    sessions.touch(session_id)
     return []
 
-# Gradio interface
-with gr.Blocks(
-    css="""
-    /* Keep the overall app background dark */
-    .gradio-container {
-        background-color: #1f1f1f !important;
-    }
+def build_interface():
+    """
+    Build the Gradio interface. Gradio is imported here, it takes seconds to import and is only needed to serve the UI.
+    """
+    import gradio as gr
 
-    /* Make all "block" containers green.
-       Gradio usually wraps components in divs with the class "block" */
-    .block {
-        background-color: #00ff00 !important;
-        padding: 1rem !important;
-        border-radius: 8px !important;
-    }
+    with gr.Blocks(
+        css="""
+        /* Keep the overall app background dark */
+        .gradio-container {
+            background-color: #1f1f1f !important;
+        }
 
-    /* Any titles (headings or labels) inside these blocks should be black and bold */
-    .block h1, .block h2, .block h3, .block label {
-        color: #000000 !important;
-        font-weight: bold !important;
-    }
+        /* Make all "block" containers green.
+           Gradio usually wraps components in divs with the class "block" */
+        .block {
+            background-color: #00ff00 !important;
+            padding: 1rem !important;
+            border-radius: 8px !important;
+        }
 
-    /* Override the input text box areas so they stay white.
-       This applies both to their container and the actual input field. */
-    .gr-textbox {
-        background-color: #ffffff !important;
-        padding: 8px !important;
-        border-radius: 4px !important;
-    }
-    .gr-textbox input {
-        background-color: #ffffff !important;
-        color: #000000 !important;
-        border: 1px solid #cccccc !important;
-        padding: 4px !important;
-        border-radius: 4px !important;
-    }
+        /* Any titles (headings or labels) inside these blocks should be black and bold */
+        .block h1, .block h2, .block h3, .block label {
+            color: #000000 !important;
+            font-weight: bold !important;
+        }
 
-    /* Optionally, keep buttons green (with white text) */
-    .gr-button {
-        background-color: #00ff00 !important;
-        color: #ffffff !important;
-    }
+        /* Override the input text box areas so they stay white.
+           This applies both to their container and the actual input field. */
+        .gr-textbox {
+            background-color: #ffffff !important;
+            padding: 8px !important;
+            border-radius: 4px !important;
+        }
+        .gr-textbox input {
+            background-color: #ffffff !important;
+            color: #000000 !important;
+            border: 1px solid #cccccc !important;
+            padding: 4px !important;
+            border-radius: 4px !important;
+        }
 
-    /* If your output textbox is also a gr-textbox and should be white: */
-    .gradio-container .gr-textbox[interactive="false"] {
-        background-color: #ffffff !important;
-        color: #000000 !important;
-    }
-"""
-) as demo:
-    # Remove the session ID generation from here
-    session_id = gr.State()  # Initialize empty state
+        /* Optionally, keep buttons green (with white text) */
+        .gr-button {
+            background-color: #00ff00 !important;
+            color: #ffffff !important;
+        }
+
+        /* If your output textbox is also a gr-textbox and should be white: */
+        .gradio-container .gr-textbox[interactive="false"] {
+            background-color: #ffffff !important;
+            color: #000000 !important;
+        }
+    """
+    ) as demo:
+        # Remove the session ID generation from here
+        session_id = gr.State()  # Initialize empty state
     
-    gr.Markdown("# Tool-Calling LLM Chatbot")
-    gr.Markdown("Ask questions, and the chatbot will respond using registered tools.")
+        gr.Markdown("# Tool-Calling LLM Chatbot")
+        gr.Markdown("Ask questions, and the chatbot will respond using registered tools.")
     
-    # Create a function to generate and display session ID
-    def create_session():
-        new_id = str(uuid.uuid4())
-        return new_id
-        # return new_id, f"Session ID: {new_id}"
+        # Create a function to generate and display session ID
+        def create_session():
+            new_id = str(uuid.uuid4())
+            return new_id
+            # return new_id, f"Session ID: {new_id}"
     
-    # session_text = gr.Markdown()  # Add markdown component for session ID display
+        # session_text = gr.Markdown()  # Add markdown component for session ID display
     
-    # Generate new session ID when interface loads
-    demo.load(
-        fn=create_session,
-        outputs=[session_id],
-    )
-
-    # Rest of the interface components
-    chatbot = gr.Chatbot(label="Chat History")
-    with gr.Row():
-        user_input = gr.Textbox(label="Your Message", placeholder="Type your question here...")
-        submit_button = gr.Button("Send")
-
-    # Handle user input
-    submit_button.click(
-        fn=chat_with_llm,
-        inputs=[user_input, session_id],
-        outputs=[chatbot],
-    )
-
-    # Clear button to reset the chat
-    clear_button = gr.Button("Clear Chat")
-    clear_button.click(
-        fn=reset_chat,
-        inputs=[session_id],
-        outputs=[chatbot],
-    )
-
-# Launch the Gradio app
-demo.launch(share=True, server_port=7866)
\ No newline at end of file
+        # Generate new session ID when interface loads
+        demo.load(
+            fn=create_session,
+            outputs=[session_id],
+        )
+
+        # Rest of the interface components
+        chatbot = gr.Chatbot(label="Chat History")
+        with gr.Row():
+            user_input = gr.Textbox(label="Your Message", placeholder="Type your question here...")
+            submit_button = gr.Button("Send")
+
+        # Handle user input
+        submit_button.click(
+            fn=chat_with_llm,
+            inputs=[user_input, session_id],
+            outputs=[chatbot],
+            concurrency_limit=CHAT_CONCURRENCY_LIMIT,
+        )
+
+        # Clear button to reset the chat
+        clear_button = gr.Button("Clear Chat")
+        clear_button.click(
+            fn=reset_chat,
+            inputs=[session_id],
+            outputs=[chatbot],
+            concurrency_limit=CHAT_CONCURRENCY_LIMIT,
+        )
+
+    return demo
+
+def main():
+    """
+    Boot the chat server: warm up the shared LLM, start the session sweeper and the metrics endpoint, and launch Gradio.
+    """
+    # Load the embedding model and build the shared tool registry at boot instead of on the first user request
+    embeddings.warmup()
+    get_shared_llm()
+
+    # Evict the idle sessions in the background
+    sessions.start_sweeper()
+
+    metrics.register_collector("sessions", sessions.stats)
+    if METRICS_PORT:
+        serve_metrics(int(METRICS_PORT))
+
+    # Launch the Gradio app
+    build_interface().launch(share=True, server_port=7866)
+
+
+if __name__ == "__main__":
+    main()
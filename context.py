@@ -0,0 +1,122 @@
+import re
+from typing import Dict, List
+
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+MESSAGE_OVERHEAD_TOKENS = 4 # role and separators of a message in the chat template
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a text locally (no tokenizer download, no network call).
+    Words and punctuation are counted, with a floor of one token per 4 characters for long tokens (addresses, hashes...).
+    """
+    if not text:
+        return 0
+    return max(len(text) // 4, len(_TOKEN_PATTERN.findall(text)))
+
+
+def estimate_message_tokens(message: Dict) -> int:
+    return estimate_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Truncate a text to about max_tokens tokens, with a marker of how much was cut.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max_tokens * 4
+    return f"{text[:max_chars]}... [truncated {len(text) - max_chars} characters]"
+
+
+class ContextWindow:
+    """
+    Fit the conversation sent to the LLM into a token budget.
+    The system prompt and the current turn (the latest user message and what follows it) are always kept.
+    The previous turns are added from the most recent one while they fit in the budget, with their tool outputs truncated;
+    the older turns are collapsed into a short summary of the user requests.
+    """
+    def __init__(self, max_tokens: int = 4096, max_past_tool_output_tokens: int = 200, summary_tokens: int = 300):
+        """
+        Args:
+            max_tokens: Token budget of the messages sent to the LLM.
+            max_past_tool_output_tokens: Maximum tokens of a tool output of a previous turn.
+            summary_tokens: Maximum tokens of the summary of the dropped turns (no summary if 0).
+        """
+        self.max_tokens = max_tokens
+        self.max_past_tool_output_tokens = max_past_tool_output_tokens
+        self.summary_tokens = summary_tokens
+
+    def _split_turns(self, messages: List[Dict]) -> List[List[Dict]]:
+        """
+        Split messages into turns, each one starting with a user message.
+        """
+        turns = []
+        for message in messages:
+            if message["role"] == "user" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return turns
+
+    def _compact_turn(self, turn: List[Dict]) -> List[Dict]:
+        """
+        Truncate the tool outputs of a previous turn.
+        """
+        return [
+            {**message, "content": truncate_to_tokens(message["content"], self.max_past_tool_output_tokens)}
+            if message["role"] == "ipython" else message
+            for message in turn
+        ]
+
+    def _summarize(self, turns: List[List[Dict]]) -> Dict:
+        """
+        Collapse dropped turns into a short summary of the user requests.
+        """
+        # Keep the most recent requests that fit in the summary budget
+        requests = []
+        used = 0
+        for turn in reversed(turns):
+            if turn[0]["role"] != "user":
+                continue
+            request = truncate_to_tokens(turn[0]["content"], 40)
+            used += estimate_tokens(request)
+            if used > self.summary_tokens:
+                break
+            requests.insert(0, request)
+        if not requests:
+            return None
+        return {"role": "system", "content": "Earlier in the conversation, the user asked: " + " | ".join(requests)}
+
+    def apply(self, messages: List[Dict]) -> List[Dict]:
+        """
+        Build the list of messages to send to the LLM. The messages themselves are not modified.
+        """
+        system = [message for message in messages[:1] if message["role"] == "system"]
+        turns = self._split_turns(messages[len(system):])
+        if not turns:
+            return list(messages)
+
+        current_turn = turns[-1]
+        used = sum(estimate_message_tokens(message) for message in system + current_turn)
+        kept = []
+        dropped = []
+        for index in range(len(turns) - 2, -1, -1):
+            turn = self._compact_turn(turns[index])
+            tokens = sum(estimate_message_tokens(message) for message in turn)
+            if used + tokens > self.max_tokens:
+                dropped = turns[:index + 1]
+                break
+            kept.insert(0, turn)
+            used += tokens
+
+        window = list(system)
+        if dropped and self.summary_tokens:
+            summary = self._summarize(dropped)
+            if summary is not None:
+                window.append(summary)
+        for turn in kept:
+            window.extend(turn)
+        window.extend(current_turn)
+        return window
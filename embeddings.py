@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+import numpy as np
+from cache import file_lock
+from telemetry import log, span
+
+if TYPE_CHECKING: # sentence_transformers (and torch) take seconds to import, they are imported with the first model
+    from sentence_transformers import SentenceTransformer
+
+
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of embedding models.
+    Each model is loaded once on first use and shared by every caller (e.g. all the ToolManager instances).
+    """
+    def __init__(self):
+        self._models: Dict[str, "SentenceTransformer"] = {} # loaded models by name
+        self._lock = threading.Lock()
+
+    def get(self, model_name: str = DEFAULT_MODEL_NAME) -> "SentenceTransformer":
+        """
+        Get a model by name, loading it on first use.
+        Loading happens under a lock so concurrent first calls only load the model once.
+        """
+        model = self._models.get(model_name)
+        if model is not None:
+            return model
+
+        with self._lock:
+            # Another thread may have loaded the model while we were waiting for the lock
+            model = self._models.get(model_name)
+            if model is None:
+                log("info", f"Loading embedding model: {model_name}")
+                with span("model_load", model=model_name):
+                    from sentence_transformers import SentenceTransformer
+                    model = SentenceTransformer(model_name)
+                self._models[model_name] = model
+        return model
+
+    def register(self, model, model_name: str = DEFAULT_MODEL_NAME):
+        """
+        Register an already built model under a name (e.g. a stand-in model for benchmarks),
+        in place of the SentenceTransformer that would be loaded on first use.
+        """
+        with self._lock:
+            self._models[model_name] = model
+
+    def warmup(self, *model_names: str):
+        """
+        Load the given models (the default model if none given) ahead of time,
+        so that the cold-start cost is paid at boot and not on the request path.
+        """
+        for model_name in model_names or (DEFAULT_MODEL_NAME,):
+            self.get(model_name)
+
+    def unload(self, model_name: str = None):
+        """
+        Unload a model (all models if no name given). It will be reloaded on next use.
+        """
+        with self._lock:
+            if model_name is None:
+                self._models.clear()
+            else:
+                self._models.pop(model_name, None)
+
+    def is_loaded(self, model_name: str = DEFAULT_MODEL_NAME) -> bool:
+        """
+        Check if a model is currently loaded.
+        """
+        return model_name in self._models
+
+
+# Shared registry for the whole process
+model_registry = ModelRegistry()
+
+
+def get_model(model_name: str = DEFAULT_MODEL_NAME) -> "SentenceTransformer":
+    """
+    Get a shared embedding model from the process-wide registry.
+    """
+    return model_registry.get(model_name)
+
+
+def warmup(*model_names: str):
+    """
+    Load embedding models at boot. See `ModelRegistry.warmup`.
+    """
+    model_registry.warmup(*model_names)
+
+
+def unload(model_name: str = None):
+    """
+    Unload embedding models. See `ModelRegistry.unload`.
+    """
+    model_registry.unload(model_name)
+
+
+class EmbeddingCache:
+    """
+    Persistent on-disk cache of text embeddings, keyed by a hash of the model name and the text.
+    The embeddings of a model are stored in a raw float32 file that is memory-mapped on load,
+    next to a JSON index of the keys (the i-th key is the i-th row of the file).
+    New embeddings are kept in memory until `flush` appends them to the files.
+    Several processes can share the cache directory: the flushes are serialized by a file lock,
+    and the rows already indexed (and possibly memory-mapped by another process) are never rewritten.
+    """
+    def __init__(self, cache_dir: str, model_name: str = DEFAULT_MODEL_NAME):
+        self.model_name = model_name
+        file_name = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+        self.data_path = os.path.join(cache_dir, f"{file_name}.f32")
+        self.index_path = os.path.join(cache_dir, f"{file_name}.json")
+        self._keys: List[str] = [] # row -> key
+        self._rows: Dict[str, int] = {} # key -> row
+        self._dim: Optional[int] = None
+        self._data: Optional[np.ndarray] = None # memory-mapped (n_rows, dim) matrix
+        self._pending: Dict[str, np.ndarray] = {} # embeddings not yet written to disk
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self):
+        return len(self._rows) + len(self._pending)
+
+    def key(self, text: str) -> str:
+        """
+        Cache key of a text: a hash of the model name and the text.
+        """
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _read_index(self) -> Optional[Tuple[int, List[str]]]:
+        """
+        Read the (dim, keys) of the key index on disk. A missing or corrupted cache is treated as empty (None).
+        """
+        if not (os.path.exists(self.index_path) and os.path.exists(self.data_path)):
+            return None
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            dim, keys = index["dim"], index["keys"]
+            if os.path.getsize(self.data_path) < len(keys) * dim * 4:
+                raise ValueError("embeddings file is shorter than its index")
+        except (OSError, ValueError, KeyError) as e:
+            log("warning", f"Ignoring embedding cache {self.index_path}: {e}")
+            return None
+        return dim, keys
+
+    def _load(self):
+        """
+        Load the key index and memory-map the embeddings file.
+        """
+        index = self._read_index()
+        if index is None:
+            return
+        self._dim, self._keys = index
+        self._rows = {key: row for row, key in enumerate(self._keys)}
+        self._map()
+
+    def _map(self):
+        """
+        (Re)create the memory map over the rows listed in the index.
+        """
+        if self._keys:
+            self._data = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(len(self._keys), self._dim))
+        else:
+            self._data = None
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """
+        Get the cached embedding of a text, or None if it is not cached.
+        """
+        return self.get_many([text])[0]
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Get the cached embeddings of several texts (None for the texts that are not cached).
+        """
+        results = []
+        with self._lock:
+            for text in texts:
+                key = self.key(text)
+                if key in self._pending:
+                    results.append(self._pending[key])
+                elif key in self._rows:
+                    results.append(np.array(self._data[self._rows[key]]))
+                else:
+                    results.append(None)
+        return results
+
+    def put(self, text: str, embedding: np.ndarray):
+        """
+        Add the embedding of a text to the cache. Call `flush` to persist it.
+        """
+        self.put_many([text], [embedding])
+
+    def put_many(self, texts: List[str], embeddings):
+        """
+        Add the embeddings of several texts to the cache. Call `flush` to persist them.
+        """
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                embedding = np.asarray(embedding, dtype=np.float32).ravel()
+                if self._dim is None:
+                    self._dim = embedding.shape[0]
+                elif embedding.shape[0] != self._dim:
+                    raise ValueError(f"Embedding dimension {embedding.shape[0]} does not match the cache dimension {self._dim}.")
+                key = self.key(text)
+                if key not in self._rows:
+                    self._pending[key] = embedding
+
+    def flush(self):
+        """
+        Append the pending embeddings to the embeddings file and rewrite the key index.
+        The index is replaced atomically and only lists rows that are fully written,
+        so an interrupted flush leaves a valid (smaller) cache behind.
+        The flush runs under a file lock and starts from the index on disk, so the rows appended by other processes
+        are kept, and the file is only ever cut past the indexed rows (the ones other processes may have mapped).
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            os.makedirs(os.path.dirname(self.data_path) or ".", exist_ok=True)
+            with file_lock(f"{self.data_path}.lock"):
+                index = self._read_index()
+                if index is not None and index[0] == self._dim:
+                    self._keys = index[1]
+                else:
+                    self._keys = []
+                self._rows = {key: row for row, key in enumerate(self._keys)}
+                keys = [key for key in self._pending if key not in self._rows] # another process may have added some
+                self._data = None # release the memory map before writing to the file
+                if keys:
+                    data = np.stack([self._pending[key] for key in keys]).astype(np.float32)
+                    with open(self.data_path, "ab") as f:
+                        f.truncate(len(self._keys) * self._dim * 4) # drop rows left by an interrupted flush
+                        f.write(data.tobytes())
+                    for key in keys:
+                        self._rows[key] = len(self._keys)
+                        self._keys.append(key)
+                    tmp_path = f"{self.index_path}.tmp"
+                    with open(tmp_path, "w") as f:
+                        json.dump({"model_name": self.model_name, "dim": self._dim, "keys": self._keys}, f)
+                    os.replace(tmp_path, self.index_path)
+            self._pending.clear()
+            self._map()
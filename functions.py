@@ -1,11 +1,80 @@
-from moralis import sol_api
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Union
+from urllib.parse import quote
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from intents import SLOT_PATTERNS
 import os
+import re
 import requests
 
 load_dotenv()
 
 MORALIS_API_KEY = os.getenv('MORALIS_API_KEY')
+MORALIS_SOLANA_URL = "https://solana-gateway.moralis.io"
+WHALE_ANALYSIS_URL = "http://35.172.214.184:5000/api/whale-analysis"
+
+# HTTP settings of the upstream data calls
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5)) # seconds
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30)) # seconds
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 32)) # keep-alive connections per host
+BULK_MAX_WORKERS = int(os.getenv('BULK_MAX_WORKERS', 8)) # concurrent requests of the bulk functions
+
+# Shared keep-alive connection pool for all the upstream calls
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+MORALIS_NETWORKS = ("mainnet", "devnet")
+ADDRESS_PATTERN = dict(SLOT_PATTERNS)["address"] # base58 Solana address
+
+def _moralis_path(kind: str, network: str, address: str, endpoint: str) -> str:
+    """
+    Build a Moralis Solana API path from LLM-provided arguments.
+    The arguments are validated and escaped: an address like "X/../../account/..." must not reach another endpoint
+    with the API key. Raises a ValueError for an unknown network or a malformed address.
+    """
+    if network not in MORALIS_NETWORKS:
+        raise ValueError(f"Unknown network '{network}', expected one of: {', '.join(MORALIS_NETWORKS)}")
+    if not isinstance(address, str) or not ADDRESS_PATTERN.fullmatch(address):
+        raise ValueError(f"Invalid Solana address '{address}'")
+    return "/" + "/".join(quote(segment, safe="") for segment in (kind, network, address, endpoint))
+
+def _moralis_get(path: str):
+    """
+    GET a Moralis Solana API endpoint through the shared connection pool.
+    Raises an HTTPError for bad responses (4xx, 5xx) and a Timeout if the endpoint does not answer in time.
+    """
+    response = session.get(
+        f"{MORALIS_SOLANA_URL}{path}",
+        headers={"X-API-Key": MORALIS_API_KEY, "Accept": "application/json"},
+        timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+    )
+    response.raise_for_status()
+    return response.json()
+
+def fetch_many(func: Callable, addresses: Union[str, List[str]], **kwargs) -> Dict:
+    """
+    Call func for many addresses concurrently (at most BULK_MAX_WORKERS requests at a time).
+    A failed address does not fail the others: the result has the successful results and the errors by address.
+
+    Returns:
+        {"results": {address: result}, "errors": {address: error message}}
+    """
+    if isinstance(addresses, str):
+        # The LLM may pass a single address (or a comma-separated list) instead of a list: iterating the string would
+        # make one request per character
+        addresses = [address for address in re.split(r"[\s,]+", addresses) if address]
+    addresses = list(dict.fromkeys(addresses)) # deduplicate, keep the order
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, min(BULK_MAX_WORKERS, len(addresses)))) as executor:
+        futures = {address: executor.submit(func, address, **kwargs) for address in addresses}
+        for address, future in futures.items():
+            try:
+                results[address] = future.result()
+            except Exception as e:
+                errors[address] = str(e)
+    return {"results": results, "errors": errors}
 
 # def search_arxiv_papers(query: str, max_results: int = 5):
 #     """Searches for papers on arxiv."""
@@ -21,91 +90,47 @@ MORALIS_API_KEY = os.getenv('MORALIS_API_KEY')
 
 def get_account_balance(address: str, network: str = "mainnet"):
     """Gets the native balance owned by solana network and address."""
-    params = {
-        "network": network, 
-        "address": address, 
-    }
-    result = sol_api.account.balance(
-        api_key=MORALIS_API_KEY,
-        params=params,
-    )
-    return result
+    return _moralis_get(_moralis_path("account", network, address, "balance"))
 
 def get_account_nfts(address: str, network: str = "mainnet"):
     """Gets NFTs owned by a given network and address."""
-    params = {
-        "network": network,
-        "address": address,
-    }
-    result = sol_api.account.get_nfts(
-        api_key=MORALIS_API_KEY,
-        params=params,
-    )
-    return result
+    return _moralis_get(_moralis_path("account", network, address, "nft"))
 
 def get_account_portfolio(address: str, network: str = "mainnet"):
     """Gets the portfolio for a given network and address."""
-    params = {
-        "network": network,
-        "address": address,
-    }
-    result = sol_api.account.get_portfolio(
-        api_key=MORALIS_API_KEY,
-        params=params,
-    )
-    return result
+    return _moralis_get(_moralis_path("account", network, address, "portfolio"))
 
 def get_account_spl(address: str, network: str = "mainnet"):
     """Gets the token balances owned by a given network and address."""
-    params = {
-        "network": network,
-        "address": address,
-    }
-    result = sol_api.account.get_spl(
-        api_key=MORALIS_API_KEY,
-        params=params,
-    )
-    return result
+    return _moralis_get(_moralis_path("account", network, address, "tokens"))
+
+def get_account_balances(addresses: List[str], network: str = "mainnet"):
+    """Gets the native balances of many accounts on a given network (partial results on per-account failure)."""
+    return fetch_many(get_account_balance, addresses, network=network)
 
 # NFT API
 
 def get_nft_metadata(contract_address: str, network: str = "mainnet"):
     """Get the global NFT metadata for a given network and contract (mint, standard, name, symbol, metaplex)."""
-    params = {
-        "network": network,
-        "address": contract_address
-    }
-    result = sol_api.nft.get_nft_metadata(
-        api_key=MORALIS_API_KEY,
-        params=params,
-    )
-    return result
+    return _moralis_get(_moralis_path("nft", network, contract_address, "metadata"))
 
 # Token API
 
 def get_token_price(contract_address: str, network: str = "mainnet"):
     """Gets the token price (usd and native) for a given contract address and network."""
-    params = {
-        "network": network,
-        "address": contract_address 
-    }
-    result = sol_api.token.get_token_price(
-        api_key=MORALIS_API_KEY,
-        params=params,
-    )
-    return result
+    return _moralis_get(_moralis_path("token", network, contract_address, "price"))
 
 def get_token_metadata(contract_address: str, network: str = "mainnet"):
     """Get the global token metadata for a given network and contract (mint, standard, name, symbol, metaplex)."""
-    params = {
-        "network": network,
-        "address": contract_address
-    }
-    result = sol_api.token.get_token_metadata(
-        api_key=MORALIS_API_KEY,
-        params=params,
-    )
-    return result
+    return _moralis_get(_moralis_path("token", network, contract_address, "metadata"))
+
+def get_token_prices(contract_addresses: List[str], network: str = "mainnet"):
+    """Gets the prices of many tokens on a given network (partial results on per-token failure)."""
+    return fetch_many(get_token_price, contract_addresses, network=network)
+
+def get_tokens_metadata(contract_addresses: List[str], network: str = "mainnet"):
+    """Gets the global metadata of many tokens on a given network (partial results on per-token failure)."""
+    return fetch_many(get_token_metadata, contract_addresses, network=network)
 
 
 
@@ -122,14 +147,13 @@ def get_whale_analysis(token_address: str, prompt: str) -> dict:
         dict: The analysis response from the API
     """
     
-    url = "http://35.172.214.184:5000/api/whale-analysis"
     payload = {
         "token_address": token_address,
         "prompt": prompt
     }
     
     try:
-        response = requests.post(url, json=payload)
+        response = session.post(WHALE_ANALYSIS_URL, json=payload, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
         response.raise_for_status()  # Raises an HTTPError for bad responses (4xx, 5xx)
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -0,0 +1,170 @@
+import json
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+from cache import LRUCache
+from telemetry import metrics
+
+
+# Values extracted from the queries, in the order they are tried: Solana addresses, network names and numbers
+SLOT_PATTERNS = [
+    ("address", re.compile(r"\b[1-9A-HJ-NP-Za-km-z]{32,44}\b")),
+    ("network", re.compile(r"\b(?i:mainnet|devnet|testnet)\b")),
+    ("number", re.compile(r"\b\d+(?:\.\d+)?\b")),
+]
+_SLOT_PATTERN = re.compile("|".join(f"(?P<{kind}>{pattern.pattern})" for kind, pattern in SLOT_PATTERNS))
+_ADDRESS_PATTERN = SLOT_PATTERNS[0][1]
+
+
+def query_template(query: str) -> Tuple[str, List[str]]:
+    """
+    Split a query into a template and its slot values:
+    "Balance of 7xKX...sU on devnet?" -> ("balance of <address> on <network>", ["7xKX...sU", "devnet"]).
+    Case, punctuation and spacing are normalized in the template.
+    """
+    values = []
+
+    def replace(match):
+        values.append(match.group(0))
+        return f" <{match.lastgroup}> "
+
+    # Addresses are case-sensitive, the slots are extracted before the query is lowercased
+    template = _SLOT_PATTERN.sub(replace, query)
+    template = re.sub(r"[^\w<>]+", " ", template.lower()).strip()
+    return template, values
+
+
+def _to_number(text: str) -> Optional[float]:
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+class IntentCache:
+    """
+    Cache of the tool calls made for template-identical queries ("price of <address>", "balance of <address> on <network>"),
+    learned from the successful turns: a turn with a single function call records the template of the query,
+    the function, and which slot of the query each argument comes from (or its constant value).
+    Once a template has been seen min_observations times with the same call (and at least min_confidence of
+    its observations agree), the call of a new query with this template is made without asking the LLM.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 24 * 3600, min_observations: int = 2, min_confidence: float = 0.9):
+        """
+        Args:
+            max_size: Maximum number of templates. The least recently used template is evicted beyond that.
+            ttl: Time-to-live of the templates in seconds (never expire if None).
+            min_observations: Number of agreeing observations before a template is used.
+            min_confidence: Minimum fraction of the observations of a template that agree on the call.
+        """
+        self.min_observations = min_observations
+        self.min_confidence = min_confidence
+        self.hits = 0
+        self.misses = 0
+        self.llm_calls_saved = 0
+        self._entries = LRUCache(max_size=max_size, ttl=ttl) # template -> {"call": ..., "agreeing": ..., "observations": ...}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _generalize(self, function_call: Dict, values: List[str]) -> Optional[Dict]:
+        """
+        Turn a function call into a call pattern: the arguments found in the query slots become slot references.
+        Returns None if the call cannot be generalized safely (an address that does not come from the query,
+        e.g. taken from a previous turn).
+        """
+        lowered = [slot.lower() for slot in values]
+        numbers = [_to_number(slot) for slot in values]
+        arguments = {}
+        for name, value in function_call["parameters"].items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and value in numbers:
+                arguments[name] = {"slot": numbers.index(value), "type": type(value).__name__}
+            elif isinstance(value, str) and value in values:
+                arguments[name] = {"slot": values.index(value)}
+            elif isinstance(value, str) and value.lower() in lowered:
+                arguments[name] = {"slot": lowered.index(value.lower()), "type": "lower"}
+            elif isinstance(value, str) and _ADDRESS_PATTERN.search(value):
+                return None
+            else:
+                arguments[name] = {"value": value}
+        return {"name": function_call["name"], "arguments": arguments}
+
+    def record(self, query: str, function_call: Dict):
+        """
+        Record the function call made for a query after a successful turn.
+        """
+        template, values = query_template(query)
+        call = self._generalize(function_call, values)
+        if call is None:
+            return
+        with self._lock:
+            entry = self._entries.get(template, count=False)
+            if entry is None:
+                entry = {"call": call, "agreeing": 0, "observations": 0}
+            entry["observations"] += 1
+            if entry["call"] == call:
+                entry["agreeing"] += 1
+            elif entry["agreeing"] <= entry["observations"] / 2:
+                entry = {"call": call, "agreeing": 1, "observations": entry["observations"]} # the new call is the majority
+            self._entries.set(template, entry)
+
+    def lookup(self, query: str) -> Optional[Dict]:
+        """
+        Get the function call ({"name": ..., "parameters": ...}) for a query whose template is known with enough confidence.
+        """
+        template, values = query_template(query)
+        with self._lock:
+            entry = self._entries.get(template, count=False)
+        confident = (
+            entry is not None
+            and entry["agreeing"] >= self.min_observations
+            and entry["agreeing"] / entry["observations"] >= self.min_confidence
+        )
+        if not confident or any(argument.get("slot", -1) >= len(values) for argument in entry["call"]["arguments"].values()):
+            self.misses += 1
+            return None
+        parameters = {}
+        for name, argument in entry["call"]["arguments"].items():
+            if "slot" not in argument:
+                parameters[name] = json.loads(json.dumps(argument["value"])) # copy, the call may modify its arguments
+                continue
+            value = values[argument["slot"]]
+            kind = argument.get("type")
+            if kind == "lower":
+                value = value.lower()
+            elif kind in ("int", "float"):
+                number = _to_number(value)
+                if number is None or (kind == "int" and number != int(number)):
+                    self.misses += 1
+                    return None
+                value = int(number) if kind == "int" else float(number)
+            parameters[name] = value
+        self.hits += 1
+        return {"name": entry["call"]["name"], "parameters": parameters}
+
+    def invalidate(self, query: str):
+        """
+        Forget the template of a query (e.g. after the cached call failed).
+        """
+        self._entries.delete(query_template(query)[0])
+
+    def saved(self, llm_calls: int = 1):
+        """
+        Count the LLM calls saved by the cache.
+        """
+        self.llm_calls_saved += llm_calls
+        metrics.inc("intent_cache_llm_calls_saved_total", llm_calls)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Hit/miss counters, hit rate and number of LLM calls saved by the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "llm_calls_saved": self.llm_calls_saved,
+        }
@@ -1,8 +1,19 @@
+import asyncio
+import hashlib
+import inspect
 import json
-from typing import Dict, Callable, List
-from openai import OpenAI
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import AsyncIterator, Dict, Callable, Generator, Iterator, List, Optional, Set, Tuple
 from datetime import datetime
-from tools import ToolManager
+from answers import AnswerCache
+from cache import CachedFunction, LRUCache
+from context import ContextWindow, estimate_message_tokens, estimate_tokens
+from intents import IntentCache
+from shaping import ResultShaper, compact_json
+from telemetry import log, metrics, span
+from tools import ToolIndex, ToolManager
 
 
 HYPERBOLIC_ENDPOINT_URL = "https://api.hyperbolic.xyz/v1"
@@ -13,24 +24,157 @@ ENDPOINT_URL = HYPERBOLIC_ENDPOINT_URL
 MODEL_NAME = "meta-llama/Llama-3.3-70B-Instruct"
 # MODEL_NAME = "meta-llama/Llama-3.3-70B-Instruct-Turbo"
 
+EMBEDDING_CACHE_DIR = ".cache/embeddings" # on-disk cache of the tool embeddings
 
-current_date = datetime.now()
-formatted_date = current_date.strftime("%d %B %Y")
+MAX_TOOL_THREADS = 64 # process-wide limit of the threads running function calls, calls hung past their timeout included
+_tool_thread_slots = threading.BoundedSemaphore(MAX_TOOL_THREADS)
+TOOL_THREAD_POLL_INTERVAL = 0.01 # seconds between two attempts of an async call to get a thread slot
 
 
+PYTHON_TAG = "<|python_tag|>" # marker some Llama models put before a function call
+
+FULL_RESULT_FUNCTION = "get_full_result" # built-in function to read a compacted function result in full
+COMPACTED_MAX_ITEMS = (10, 5, 2, 1, 0) # list sizes tried in turn to fit a compacted result in max_result_chars
+FULL_RESULT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": FULL_RESULT_FUNCTION,
+        "description": "Get the full data of a function result that was compacted, page by page.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "result_id": {"type": "string", "description": "The result_id of the compacted result"},
+                "offset": {"type": "integer", "description": "Character offset of the page", "default": 0}
+            },
+            "required": ["result_id"]
+        }
+    }
+}
+
+
+# Static part of the system prompt, built once
+SYSTEM_PROMPT_INSTRUCTIONS = """
+Environment: ipython
+Cutting Knowledge Date: December 2023
+You are a helpful assistant with tool calling capabilities.
+You have access to the functions listed at the end of this message.
+If the user's request requires calling a function:
+    1. Check if the function requires a prompt.
+    2. If the function requires a prompt, assign the user's request as the prompt parameter of the function.
+    3. Check if all the required parameters are provided in the user's request.
+    4. If all the required parameters are provided, proceed as follows:
+        - Respond with a JSON object in the format:
+        {"name": "function_name", "parameters": {"param1": "value1", "param2": "value2"}}. 
+        - To call several functions at once, respond with a JSON array of such objects.
+        - Make sure not to add any extra information.
+        - Return only an instance of the JSON, NOT the schema itself.
+    5. If some of the required parameters are missing, proceed as follows:
+        - Ask the user for the required parameters that are missing only.
+        - Make sure not to fill in a required parameter yourself.  
+        - Fill in the optional parameters with their default values.
+        - Make sure not to ask the user for parameters that are optional. 
+        - Do not share your thoughts and reasoning process.
+        - Examples of valid responses:
+            - "I need more information to proceed. Could you please provide the token address?"
+            - "For which account do you want to get the balance?"
+        - Be very creative, use variations of the examples above.
+        - Examples of invalid responses:
+            - "To answer the query, I need to call a function: {"name": "function_name", "parameters": {"param1": "value1", "param2": "value2"}}"
+            (reason for invalidity: response contains the reasoning process)
+            - "<|python_tag|>{"name": "function_name", "parameters": {"param1": "value1", "param2": "value2"}}"
+            (reason for invalidity: response contains extra information like <|python_tag|>)
+    6. If the function call returns an error, proceed as follows:
+        - Respond with a friendly non technical message to explain the error
+        - Analyze the error and guide the user to try again with the correct parameters.
+        - Make sure not to share the error message with the user.
+If the user request does not necessitate a function call, simply respond to the user's query directly.
+""".strip()
+
+
+def get_formatted_date() -> str:
+    """
+    Today's date for the system prompt, computed on each call so it stays correct across days.
+    """
+    return datetime.now().strftime("%d %B %Y")
+
+
+def _api_timeout_error() -> type:
+    """
+    Timeout exception of the openai package, looked up when an exception is being handled
+    (the package is already imported by then, the clients are created on first use).
+    """
+    from openai import APITimeoutError
+    return APITimeoutError
+
 
 class ToolCallingLLM:
-    def __init__(self, api_key: str, model_name: str = MODEL_NAME):
+    def __init__(self, api_key: str, model_name: str = MODEL_NAME, embedding_cache_dir: str = EMBEDDING_CACHE_DIR, tool_index: ToolIndex = None,
+                 max_parallel_tool_calls: int = 8, tool_call_timeout: float = 30.0, result_cache=None, context_window: ContextWindow = None,
+                 max_result_chars: int = 4000, max_tool_steps: int = 5, turn_timeout: float = 60.0, intent_cache: IntentCache = None,
+                 answer_cache: AnswerCache = None):
         """
         Initialize the LLM with the API key and model name.
+        The tool embeddings are cached in embedding_cache_dir (no caching if None).
+        tool_index is the index used for the tool selection (exact ToolIndex by default, IVFToolIndex for very large catalogs).
+        The function calls of one response run concurrently, at most max_parallel_tool_calls at a time,
+        and each of them fails after tool_call_timeout seconds from its start.
+        result_cache is the backend of the function result cache (in-memory LRUCache by default, or e.g. a SQLiteCache).
+        context_window fits the conversation sent to the LLM into a token budget (default ContextWindow settings if None).
+        Function results are fed to the LLM as compact JSON of at most max_result_chars characters;
+        the raw results of compacted ones are kept aside so the LLM can read them with get_full_result.
+        A user turn makes at most max_tool_steps rounds of function calls and lasts at most turn_timeout seconds.
+        With an intent_cache, the function calls of queries that match a learned template are made without the first LLM call.
+        With an answer_cache, the answers to questions that need no function call are reused for similar questions.
         """
         self.api_key = api_key
         self.model_name = model_name
-        self.client = OpenAI(base_url=ENDPOINT_URL,api_key=self.api_key)
+        self._client = None # OpenAI clients, created on first use (see `client`)
+        self._async_client = None
+        self.max_parallel_tool_calls = max_parallel_tool_calls
+        self.tool_call_timeout = tool_call_timeout
+        self.max_tool_steps = max_tool_steps
+        self.turn_timeout = turn_timeout
+        self.result_cache = result_cache if result_cache is not None else LRUCache(max_size=4096)
+        self.context_window = context_window if context_window is not None else ContextWindow()
+        self.max_result_chars = max_result_chars
+        self.intent_cache = intent_cache
+        self.answer_cache = answer_cache
+        # result id -> raw JSON of the compacted results. The store is shared by all the sessions, but a conversation
+        # can only read the results that were compacted in it (see `_read_full_result`)
+        self.raw_results = LRUCache(max_size=256, ttl=3600)
+        self._functions_json_cache = LRUCache(max_size=512) # selected function names -> serialized functions
         self.registered_functions = {}  # Stores registered functions and their metadata   
-        self.tool_manager = ToolManager()
+        self.tool_manager = ToolManager(cache_dir=embedding_cache_dir, index=tool_index)
 
-    def register_function(self, func: Callable, description: str, parameters: Dict):
+    @property
+    def client(self):
+        """
+        OpenAI client of the LLM endpoint. The openai package is imported on the first call, not at startup.
+        """
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(base_url=ENDPOINT_URL, api_key=self.api_key)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def async_client(self):
+        """
+        AsyncOpenAI client of the LLM endpoint, created on first use like `client`.
+        """
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(base_url=ENDPOINT_URL, api_key=self.api_key)
+        return self._async_client
+
+    @async_client.setter
+    def async_client(self, client):
+        self._async_client = client
+
+    def register_function(self, func: Callable, description: str, parameters: Dict, cache_ttl: float = None, result_shaper: Callable = None):
         """
         Register a function with its description and parameters.
         
@@ -46,30 +190,94 @@ class ToolCallingLLM:
                            },
                            "required": ["param1"]
                        }
+            cache_ttl: If set, the results of the function are cached for cache_ttl seconds
+                       and concurrent identical calls share a single call (regular functions only, not coroutines).
+            result_shaper: If set, shapes the results of the function before they are fed to the LLM (e.g. a ResultShaper).
+                           Called with the result, returns the shaped result and whether information was dropped.
         """
-        self.registered_functions[func.__name__] = {
-            "function": func,
-            "description": description,
-            "parameters": parameters,
-            "strict": True
-        }
+        self.register_functions([{"func": func, "description": description, "parameters": parameters, "cache_ttl": cache_ttl, "result_shaper": result_shaper}])
 
-        self.tool_manager.store_tool_embeddings(
-            {
-                "function": func.__name__,
-                "description": description,
-                "parameters": parameters
+    def register_functions(self, functions: List[Dict], batch_size: int = 32):
+        """
+        Register several functions at once.
+        The tool descriptions are encoded in batches and inserted into the tool index in one step.
+
+        Args:
+            functions: A list of dictionaries with the arguments of `register_function`.
+                       Example: [{"func": get_token_price, "description": "...", "parameters": {...}, "cache_ttl": 15}, ...]
+            batch_size: Number of tool descriptions encoded per forward pass.
+        """
+        tools = []
+        for function in functions:
+            func = function["func"]
+            if function.get("cache_ttl") is not None and not inspect.iscoroutinefunction(func):
+                func = CachedFunction(func, ttl=function["cache_ttl"], backend=self.result_cache)
+            self.registered_functions[func.__name__] = {
+                "function": func,
+                "description": function["description"],
+                "parameters": function["parameters"],
+                "result_shaper": function.get("result_shaper"),
+                "strict": True
             }
-        )
+            tools.append({
+                "function": func.__name__,
+                "description": function["description"],
+                "parameters": function["parameters"]
+            })
+
+        self.tool_manager.register_functions(tools, batch_size=batch_size)
+        self._functions_json_cache.clear() # the definitions of the functions may have changed
+
+    def register_functions_from_manifest(self, manifest_path: str, namespace, batch_size: int = 32):
+        """
+        Register the functions listed in a JSON manifest file.
+
+        Args:
+            manifest_path: Path to a JSON file with a list of tool definitions:
+                           [{"function": "function_name", "description": "...", "parameters": {...}, "cache_ttl": 15,
+                             "result_shaper": {"fields": [...], "max_items": 20, "decimals": 4}}, ...]
+                           ("cache_ttl" and "result_shaper" are optional)
+            namespace: The module (or dictionary) where the functions are looked up by name.
+            batch_size: Number of tool descriptions encoded per forward pass.
+        """
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+        lookup = namespace if isinstance(namespace, dict) else vars(namespace)
+        functions = []
+        for tool in manifest:
+            if tool["function"] not in lookup:
+                raise ValueError(f"Function '{tool['function']}' of the manifest is not defined.")
+            functions.append({
+                "func": lookup[tool["function"]],
+                "description": tool["description"],
+                "parameters": tool["parameters"],
+                "cache_ttl": tool.get("cache_ttl"),
+                "result_shaper": ResultShaper(**tool["result_shaper"]) if tool.get("result_shaper") else None
+            })
+        self.register_functions(functions, batch_size=batch_size)
+
+    def get_cache_stats(self) -> Dict[str, Dict]:
+        """
+        Hit rates of the function result cache, per cached function and for the whole backend.
+        """
+        stats = {
+            name: metadata["function"].stats()
+            for name, metadata in self.registered_functions.items()
+            if isinstance(metadata["function"], CachedFunction)
+        }
+        stats["backend"] = self.result_cache.stats()
+        return stats
 
 
-    def _generate_function_list(self, query: str):
+    def _generate_function_list(self, query: str, include_full_result: bool = False):
         """
         Generate a list of relevant functions in the format expected by the LLM.
+        get_full_result is added if include_full_result is True (when a result of the conversation was compacted).
         """
         tool_names = self.tool_manager.select_tools(query)
 
-        return [
+        functions_list = [
             {
                 "type": "function",
                 "function": {
@@ -80,7 +288,88 @@ class ToolCallingLLM:
             }
             for name in tool_names if name in self.registered_functions
         ]
-    
+        if include_full_result:
+            # Let the LLM read the full data of the compacted results if it needs it
+            functions_list.append(FULL_RESULT_TOOL)
+        return functions_list
+
+    def _get_full_result(self, result_id: str, offset: int = 0):
+        """
+        Get a page of the raw JSON of a compacted function result.
+        """
+        raw = self.raw_results.get(result_id)
+        if raw is None:
+            raise ValueError(f"Result '{result_id}' is not available anymore, call the function again.")
+        offset = max(0, int(offset))
+        data = raw[offset:offset + self.max_result_chars]
+        return {"result_id": result_id, "offset": offset, "data": data, "remaining_characters": max(0, len(raw) - offset - len(data))}
+
+    def _format_function_result(self, function_name: str, function_result) -> str:
+        """
+        Format a function result for the LLM: shape it with the result shaper of the function, serialize it
+        as compact JSON and cap its size. If information was dropped, the raw result is kept aside
+        and the LLM is told how to read it with get_full_result.
+        """
+        if function_name == FULL_RESULT_FUNCTION:
+            return compact_json(function_result)
+
+        shaper = self.registered_functions.get(function_name, {}).get("result_shaper")
+        shaped, dropped = shaper(function_result) if shaper is not None else (function_result, False)
+        content = compact_json(shaped)
+        if len(content) <= self.max_result_chars and not dropped:
+            return content
+
+        raw = compact_json(function_result)
+        result_id = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:12]
+        self.raw_results.set(result_id, raw)
+        envelope = {
+            "compacted": True,
+            "result_id": result_id,
+            "note": f"The result was compacted, call {FULL_RESULT_FUNCTION} with this result_id for the full data."
+        }
+        # Size cap: the lists are cut shorter and shorter until the whole message fits, the result is left out if it never does
+        for max_items in (None,) + COMPACTED_MAX_ITEMS:
+            if max_items is None:
+                candidate = shaped
+            elif isinstance(shaper, ResultShaper):
+                candidate, _ = shaper.with_max_items(max_items)(function_result)
+            else:
+                candidate, _ = ResultShaper(max_items=max_items)(shaped)
+            content = compact_json({"result": candidate, **envelope})
+            if len(content) <= self.max_result_chars:
+                return content
+        return compact_json(envelope)
+
+    def _get_compacted_result_ids(self, messages: List[Dict]) -> Set[str]:
+        """
+        Get the ids of the compacted function results of a conversation.
+        """
+        result_ids = set()
+        for message in messages:
+            if message["role"] != "ipython" or '"compacted":true' not in message["content"]:
+                continue
+            try:
+                result = json.loads(message["content"])
+            except json.JSONDecodeError:
+                continue
+            if isinstance(result, dict) and result.get("compacted"):
+                result_ids.add(result.get("result_id"))
+        return result_ids
+
+    def _read_full_result(self, messages: List[Dict], parameters: Dict) -> Tuple[object, Optional[Exception]]:
+        """
+        Run a get_full_result call of a conversation: only the results compacted in this conversation can be read.
+
+        Returns:
+            The (result, error) pair of the call.
+        """
+        try:
+            if parameters.get("result_id") not in self._get_compacted_result_ids(messages):
+                raise ValueError(f"Result '{parameters.get('result_id')}' is not a compacted result of this conversation.")
+            return self._get_full_result(**parameters), None
+        except Exception as e:
+            return None, e
+
     def _call_function(self, function_name: str, parameters: Dict):
         """
         Call a registered function with the provided parameters.
@@ -89,92 +378,79 @@ class ToolCallingLLM:
             raise ValueError(f"Function '{function_name}' is not registered.")
         
         func = self.registered_functions[function_name]["function"]
-        return func(**parameters)
+        with span("tool_call", tool=function_name):
+            return func(**parameters)
 
-    def _get_system_prompt_with_tools(self, query: str):
+    def _get_functions_json(self, functions_list: List[Dict]) -> str:
+        """
+        Serialize the selected functions as compact JSON, memoized per set of selected functions.
+        """
+        key = tuple(function["function"]["name"] for function in functions_list)
+        return self._functions_json_cache.get_or_set(key, lambda: compact_json(functions_list))
+
+    def _get_system_prompt_with_tools(self, query: str, include_full_result: bool = False):
         """
         Get the system prompt.
         """
-        # Construct the system prompt with available functions
-        functions_list = self._generate_function_list(query)
-        system_prompt = f"""
-Environment: ipython
-Cutting Knowledge Date: December 2023
-Today Date: {formatted_date}
-You are a helpful assistant with tool calling capabilities.
-You have access to the following functions (in JSON format):
-{json.dumps(functions_list, indent=4)}
-If the user's request requires calling a function:
-    1. Check if the function requires a prompt.
-    2. If the function requires a prompt, assign the user's request as the prompt parameter of the function.
-    3. Check if all the required parameters are provided in the user's request.
-    4. If all the required parameters are provided, proceed as follows:
-        - Respond with a JSON object in the format:
-        {{"name": "function_name", "parameters": {{"param1": "value1", "param2": "value2"}}}}. 
-        - Make sure not to add any extra information.
-        - Return only an instance of the JSON, NOT the schema itself.
-    5. If some of the required parameters are missing, proceed as follows:
-        - Ask the user for the required parameters that are missing only.
-        - Make sure not to fill in a required parameter yourself.  
-        - Fill in the optional parameters with their default values.
-        - Make sure not to ask the user for parameters that are optional. 
-        - Do not share your thoughts and reasoning process.
-        - Examples of valid responses:
-            - "I need more information to proceed. Could you please provide the token address?"
-            - "For which account do you want to get the balance?"
-        - Be very creative, use variations of the examples above.
-        - Examples of invalid responses:
-            - "To answer the query, I need to call a function: {{"name": "function_name", "parameters": {{"param1": "value1", "param2": "value2"}}}}"
-            (reason for invalidity: response contains the reasoning process)
-            - "<|python_tag|>{{"name": "function_name", "parameters": {{"param1": "value1", "param2": "value2"}}}}"
-            (reason for invalidity: response contains extra information like <|python_tag|>)
-    6. If the function call returns an error, proceed as follows:
-        - Respond with a friendly non technical message to explain the error
-        - Analyze the error and guide the user to try again with the correct parameters.
-        - Make sure not to share the error message with the user.
-If the user request does not necessitate a function call, simply respond to the user's query directly.
-""".strip()
+        # Construct the system prompt with available functions.
+        # The static instructions come first so that the prompt prefix stays the same across turns (provider-side prefix caching),
+        # then the date and the selected functions, which change from turn to turn.
+        functions_list = self._generate_function_list(query, include_full_result)
+        system_prompt = (
+            f"{SYSTEM_PROMPT_INSTRUCTIONS}\n"
+            f"Today Date: {get_formatted_date()}\n"
+            f"You have access to the following functions (in JSON format):\n"
+            f"{self._get_functions_json(functions_list)}"
+        )
         return system_prompt, functions_list 
     
     
+    def _get_user_query(self, messages: List[Dict]) -> str:
+        """
+        Get the content of the latest user message (the last message if there is none).
+        """
+        for message in reversed(messages):
+            if message["role"] == "user":
+                return message["content"]
+        return messages[-1]["content"]
+
     def _extract_json_from_text(self, text: str) -> str:
         """
-        Extract valid JSON from text that might contain additional markers or text.
+        Extract valid JSON (an object or an array of objects) from text that might contain additional markers or text.
         """
-        # Find the first '{' and last '}' in the text
-        start = text.find('{')
-        end = text.rfind('}')
-        
-        if start != -1 and end != -1 and end > start:
-            potential_json = text[start:end + 1]
-            try:
-                # Validate that it's proper JSON
-                json.loads(potential_json)
-                return potential_json
-            except json.JSONDecodeError:
-                return None
+        # Find the first '{' and last '}' in the text (or the first '[' and last ']' if the JSON is an array)
+        spans = [('{', '}')]
+        if '[' in text and (text.find('[') < text.find('{') or '{' not in text):
+            spans.insert(0, ('[', ']'))
+
+        for open_char, close_char in spans:
+            start = text.find(open_char)
+            end = text.rfind(close_char)
+            if start != -1 and end != -1 and end > start:
+                potential_json = text[start:end + 1]
+                try:
+                    # Validate that it's proper JSON
+                    json.loads(potential_json)
+                    return potential_json
+                except json.JSONDecodeError:
+                    continue
         return None
 
-    def generate_response(self, messages: List[Dict], temperature: float = 0.6, max_tokens: int = 512):
+    def _prepare_messages(self, messages: List[Dict]) -> List[Dict]:
         """
-        Generate a response from the LLM, handling function calls if necessary.
-        This method is recursive and will re-call the LLM with the tool result when a tool is called.
-
-        Args:
-            messages: The conversation history as a list of messages.
-            temperature: Sampling temperature for the LLM.
-            max_tokens: Maximum number of tokens to generate.
+        Select the tools for the latest user query and put the system prompt at the start of the messages.
 
         Returns:
-            The LLM's response content.
+            The list of the selected functions.
         """
-
-        if len(messages) == 0:
-            return "No messages provided."
-        
-        print(f"#### Messages:\n {messages[-1]['content']} \n####")
+        log("debug", lambda: f"Messages:\n {messages[-1]['content']}")
         # breakpoint()
-        system_prompt, functions_list = self._get_system_prompt_with_tools(messages[-1]["content"])
+        # Select the tools for the latest user query: the tool loop iterations (where the last message is a tool result)
+        # reuse the selection of the turn, served from the query embedding cache
+        with span("prompt_build"):
+            system_prompt, functions_list = self._get_system_prompt_with_tools(
+                self._get_user_query(messages), include_full_result=bool(self._get_compacted_result_ids(messages))
+            )
 
         # Ensure the system prompt is included in the messages
         if not any(msg["role"] == "system" for msg in messages):
@@ -182,80 +458,766 @@ If the user request does not necessitate a function call, simply respond to the
         else:
             messages[0]["content"] = system_prompt
 
-        print(f"#### Conversation history:\n {json.dumps(messages, indent=4)} \n####")
+        log("debug", lambda: f"Conversation history:\n {json.dumps(messages, indent=4)}")
         # breakpoint()
+        return functions_list
 
-        # Generate the LLM response
-        response = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            tools=functions_list,
-            tool_choice="auto"
-        )
+    def _is_function_call(self, value) -> bool:
+        """
+        Check if a parsed JSON value matches our expected function call format.
+        """
+        return isinstance(value, dict) and "name" in value and "parameters" in value
 
-        print(f"#### LLM raw response:\n {response} \n####")
-        # breakpoint()
+    def _parse_function_calls(self, response_content: str, tool_calls: List[Dict] = None) -> List[Dict]:
+        """
+        Parse the function calls ({"name": ..., "parameters": ...}) of an LLM response.
+        They come either from the native tool calls of the response, or from the response content
+        (a single JSON object or a JSON array of objects).
+
+        Args:
+            response_content: The text content of the response.
+            tool_calls: The native tool calls of the response, as {"name": ..., "arguments": "<json>"} dictionaries.
+
+        Returns:
+            The list of function calls, empty if the response is a regular text response.
+        """
+        if tool_calls:
+            function_calls = []
+            for tool_call in tool_calls:
+                try:
+                    parameters = json.loads(tool_call["arguments"] or "{}")
+                except json.JSONDecodeError:
+                    parameters = {}
+                function_calls.append({"name": tool_call["name"], "parameters": parameters})
+            return function_calls
 
-        # Get the response content
-        response_content = response.choices[0].message.content
-        
         # Try to parse as JSON if it looks like it might contain JSON
         if response_content and ('{' in response_content) and ('}' in response_content):
             # Try to extract clean JSON from the response
             clean_json = self._extract_json_from_text(response_content)
             if clean_json:
+                json_response = json.loads(clean_json)
+                if self._is_function_call(json_response):
+                    return [json_response]
+                if isinstance(json_response, list) and json_response and all(self._is_function_call(item) for item in json_response):
+                    return json_response
+        # Not a function call, treat as regular text response
+        return []
+
+    def _get_tool_calls(self, message) -> List[Dict]:
+        """
+        Get the native tool calls of a response message as {"name": ..., "arguments": "<json>"} dictionaries.
+        """
+        return [
+            {"name": tool_call.function.name, "arguments": tool_call.function.arguments}
+            for tool_call in (getattr(message, "tool_calls", None) or [])
+        ]
+
+    def _add_tool_call_deltas(self, tool_calls: Dict[int, Dict], delta):
+        """
+        Accumulate the native tool call fragments of a streamed chunk (by tool call index).
+        """
+        for tool_call in getattr(delta, "tool_calls", None) or []:
+            entry = tool_calls.setdefault(tool_call.index, {"name": "", "arguments": ""})
+            if tool_call.function is not None:
+                entry["name"] += tool_call.function.name or ""
+                entry["arguments"] += tool_call.function.arguments or ""
+
+    def _may_be_function_call(self, text: str) -> bool:
+        """
+        Check if the beginning of a streamed response may still turn out to be a function call,
+        i.e. if it is empty, starts with JSON or with the <|python_tag|> marker.
+        """
+        text = text.lstrip()
+        return text == "" or text.startswith(("{", "[", PYTHON_TAG)) or PYTHON_TAG.startswith(text)
+
+    def _add_function_calls(self, messages: List[Dict], function_calls: List[Dict]):
+        """
+        Add the function calls to the messages (a single JSON object for one call, a JSON array for several).
+        """
+        calls = [{"name": call["name"], "parameters": call["parameters"]} for call in function_calls]
+        messages.append({
+            "role": "assistant",
+            "content": json.dumps(calls[0] if len(calls) == 1 else calls)
+        })
+
+    def _add_function_result(self, messages: List[Dict], function_result=None, error: Exception = None, function_name: str = None):
+        """
+        Add the result of a function call (or its error) to the messages.
+        """
+        if error is not None:
+            # function call error
+            log("error", f"Error: {error}")
+            messages.append({
+                "role": "ipython",
+                "content": str(error)
+            })
+        else:
+            messages.append({
+                "role": "ipython",
+                "content": self._format_function_result(function_name, function_result)
+            })
+
+    def _add_error_response(self, messages: List[Dict], error: Exception) -> str:
+        """
+        Add a generic apology to the messages after an unhandled error.
+        """
+        # Unhandled error
+        log("error", f"Error: {error}")
+        metrics.inc("turn_errors_total")
+        response_content = "I'm sorry, I'm not able to process your request. Please, verify the details are accurate and try again. Make sure to provide all the details."
+        messages.append({
+            "role": "assistant",
+            "content": response_content
+        })
+        return response_content
+
+    def _start_call(self, function_name: str, parameters: Dict, timeout: float) -> Optional[Future]:
+        """
+        Start a function call in a thread of its own and return its future.
+        A call that hangs past its timeout keeps its thread (a thread cannot be stopped), so the threads of all the calls
+        of the process are bounded by MAX_TOOL_THREADS: a thread slot is taken before the thread is started and given
+        back when the function returns.
+
+        Returns:
+            The future of the call, or None if no thread slot was freed within timeout seconds.
+        """
+        if not _tool_thread_slots.acquire(timeout=max(0.0, timeout)):
+            return None
+        future = Future()
+
+        def run():
+            try:
+                if not future.set_running_or_notify_cancel():
+                    return
                 try:
-                    json_response = json.loads(clean_json)
-                    # Check if it matches our expected function call format
-                    if isinstance(json_response, dict) and "name" in json_response and "parameters" in json_response:
-                        function_name = json_response["name"]
-                        parameters = json_response["parameters"]
-                        
-                        # Add the function call to messages
-                        messages.append({
-                            "role": "assistant",
-                            "content": json.dumps({"name": function_name, "parameters": parameters})
-                        })
-
-                        # Call the function and add result to messages
-                        try:
-                            function_result = self._call_function(function_name, parameters)
-                            messages.append({
-                                "role": "ipython",
-                                "content": json.dumps(function_result)
-                            })
-                        except Exception as e:
-                            # function call error
-                            print(f"#### Error: {e} \n####")
-                            messages.append({
-                                "role": "ipython",
-                                "content": str(e)
-                            })
-                        # Recursive call with updated messages
-                        return self.generate_response(messages)
-                except json.JSONDecodeError:
-                    # Not a valid JSON, treat as regular text response
-                    pass
+                    future.set_result(self._call_function(function_name, parameters))
                 except Exception as e:
-                    # Unhandled error
-                    print(f"#### Error: {e} \n####")
-                    response_content = "I'm sorry, I'm not able to process your request. Please, verify the details are accurate and try again. Make sure to provide all the details."
-                    messages.append({
-                        "role": "assistant",
-                        "content": response_content
-                    })
-                    return response_content
-                    # return self.generate_response(messages)
-        # If we reach here, it's a regular text response
+                    future.set_exception(e)
+            finally:
+                _tool_thread_slots.release()
+
+        try:
+            threading.Thread(target=run, name=f"tool-call-{function_name}", daemon=True).start()
+        except Exception:
+            _tool_thread_slots.release()
+            raise
+        return future
+
+    def _run_function_calls(self, function_calls: List[Dict], turn_deadline: float = None) -> List[Tuple[object, Optional[Exception]]]:
+        """
+        Run function calls concurrently, at most max_parallel_tool_calls of this batch at a time, each with a timeout
+        counted from its start (tool_call_timeout, shortened to the deadline of the turn if there is one).
+        A call that times out frees its slot for the next calls of the batch; a call that cannot start before the deadline
+        of the turn (or before its timeout, when all the MAX_TOOL_THREADS threads are busy) times out without being started.
+
+        Returns:
+            A (result, error) pair per function call, in the order of the calls.
+        """
+        results = [None] * len(function_calls)
+        pending = list(enumerate(function_calls))
+        running = {} # index of the call -> (future, deadline of the call, timeout of the call)
+        while pending or running:
+            while pending and len(running) < self.max_parallel_tool_calls:
+                index, call = pending.pop(0)
+                timeout = self._get_tool_timeout(turn_deadline)
+                if timeout <= 0:
+                    metrics.inc("tool_call_timeouts_total", tool=call["name"])
+                    results[index] = (None, TimeoutError(f"Function '{call['name']}' was not started, the time limit of the turn was reached."))
+                    continue
+                future = self._start_call(call["name"], call["parameters"], timeout)
+                if future is None:
+                    metrics.inc("tool_call_timeouts_total", tool=call["name"])
+                    results[index] = (None, TimeoutError(f"Function '{call['name']}' was not started, no thread was free after {timeout:.1f} seconds."))
+                    continue
+                timeout = self._get_tool_timeout(turn_deadline) # counted from the start of the call
+                running[index] = (future, time.monotonic() + timeout, timeout)
+            if not running:
+                continue
+            next_deadline = min(deadline for _, deadline, _ in running.values())
+            wait([future for future, _, _ in running.values()], timeout=max(0.0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for index, (future, deadline, timeout) in list(running.items()):
+                call = function_calls[index]
+                if future.done():
+                    error = future.exception()
+                    results[index] = (None, error) if error is not None else (future.result(), None)
+                elif now >= deadline:
+                    metrics.inc("tool_call_timeouts_total", tool=call["name"])
+                    results[index] = (None, TimeoutError(f"Function '{call['name']}' timed out after {timeout:.1f} seconds."))
+                else:
+                    continue
+                del running[index]
+        return results
+
+    def _get_tool_timeout(self, turn_deadline: float = None) -> float:
+        """
+        Timeout of the function calls: tool_call_timeout, shortened to the deadline of the turn if there is one.
+        """
+        if turn_deadline is None:
+            return self.tool_call_timeout
+        return max(0.0, min(self.tool_call_timeout, turn_deadline - time.monotonic()))
+
+    async def _acall_function(self, function_name: str, parameters: Dict):
+        """
+        Call a registered function without blocking the event loop:
+        coroutine functions are awaited, regular functions run in a thread of their own.
+        """
+        if function_name not in self.registered_functions:
+            raise ValueError(f"Function '{function_name}' is not registered.")
+
+        func = self.registered_functions[function_name]["function"]
+        if not inspect.iscoroutinefunction(func):
+            # In a thread of its own rather than the default executor, which calls hung past their timeout could fill.
+            # The thread slot is polled without blocking the event loop, until the timeout of the caller cancels the wait
+            future = self._start_call(function_name, parameters, 0.0)
+            while future is None:
+                await asyncio.sleep(TOOL_THREAD_POLL_INTERVAL)
+                future = self._start_call(function_name, parameters, 0.0)
+            return await asyncio.wrap_future(future)
+        with span("tool_call", tool=function_name):
+            return await func(**parameters)
+
+    async def _arun_function_calls(self, function_calls: List[Dict], turn_deadline: float = None) -> List[Tuple[object, Optional[Exception]]]:
+        """
+        Async version of `_run_function_calls`: at most max_parallel_tool_calls calls of the batch run at a time,
+        each with a timeout counted from its start, and the calls still running at their timeout are cancelled.
+        """
+        semaphore = asyncio.Semaphore(self.max_parallel_tool_calls)
+
+        async def run(call):
+            async with semaphore:
+                timeout = self._get_tool_timeout(turn_deadline)
+                if timeout <= 0:
+                    metrics.inc("tool_call_timeouts_total", tool=call["name"])
+                    return None, TimeoutError(f"Function '{call['name']}' was not started, the time limit of the turn was reached.")
+                try:
+                    result = await asyncio.wait_for(self._acall_function(call["name"], call["parameters"]), timeout)
+                    return result, None
+                except asyncio.TimeoutError:
+                    metrics.inc("tool_call_timeouts_total", tool=call["name"])
+                    return None, TimeoutError(f"Function '{call['name']}' timed out after {timeout:.1f} seconds.")
+                except Exception as e:
+                    return None, e
+
+        return list(await asyncio.gather(*(run(call) for call in function_calls)))
+
+    def _add_function_results(self, messages: List[Dict], function_calls: List[Dict], results: List[Tuple[object, Optional[Exception]]]):
+        """
+        Add the results of the function calls to the messages, in the order of the calls.
+        """
+        for function_call, (function_result, error) in zip(function_calls, results):
+            self._add_function_result(messages, function_result, error, function_call["name"])
+
+    def _get_intent_calls(self, messages: List[Dict]) -> Optional[List[Dict]]:
+        """
+        Get the function call of a new user query from the intent cache (None if the query has to go through the LLM).
+        """
+        if self.intent_cache is None or messages[-1]["role"] != "user":
+            return None
+        function_call = self.intent_cache.lookup(messages[-1]["content"])
+        if function_call is None or function_call["name"] not in self.registered_functions:
+            return None
+        log("debug", lambda: f"Intent cache hit: {function_call}")
+        self.intent_cache.saved()
+        return [function_call]
+
+    def _add_intent_results(self, messages: List[Dict], query: str, function_calls: List[Dict], results: List[Tuple[object, Optional[Exception]]]):
+        """
+        Add the function calls served by the intent cache and their results to the messages.
+        The template of the query is forgotten if a call failed.
+        """
+        self._add_function_calls(messages, function_calls)
+        self._add_function_results(messages, function_calls, results)
+        if any(error is not None for _, error in results):
+            self.intent_cache.invalidate(query)
+
+    def _learn_intent(self, query: str, rounds: List[Tuple[List[Dict], Optional[List]]]):
+        """
+        Record the function call of a successful turn in the intent cache: only turns with a single round of
+        a single successful function call emitted by the LLM are learned.
+        """
+        if self.intent_cache is None or len(rounds) != 1:
+            return
+        function_calls, results = rounds[0]
+        if results is None or len(function_calls) != 1 or results[0][1] is not None or function_calls[0]["name"] == FULL_RESULT_FUNCTION:
+            return
+        self.intent_cache.record(query, function_calls[0])
+
+    def _is_first_turn(self, messages: List[Dict]) -> bool:
+        """
+        Check if the latest message is the first user message of the conversation (its answer depends on nothing else).
+        """
+        return messages[-1]["role"] == "user" and all(message["role"] == "system" for message in messages[:-1])
+
+    def _get_cached_answer(self, messages: List[Dict]) -> Optional[str]:
+        """
+        Get the answer to a new question from the answer cache (None if the question has to go through the LLM).
+        The query embedding is the one of the tool selection, so a miss costs no extra embedding.
+        """
+        if self.answer_cache is None or not self._is_first_turn(messages):
+            return None
+        query = messages[-1]["content"]
+        if not self.answer_cache.is_cacheable(query):
+            return None
+        answer = self.answer_cache.get(self.tool_manager.get_query_embedding(query))
+        if answer is not None:
+            log("debug", lambda: f"Answer cache hit: {query}")
+            messages.append({
+                "role": "assistant",
+                "content": answer
+            })
+        return answer
+
+    def _learn_from_turn(self, messages: List[Dict], query: str, rounds: List[Tuple[List[Dict], Optional[List]]], response_content: str):
+        """
+        Feed a successful turn to the caches, before its answer is added to the messages:
+        its function call to the intent cache, or its answer to the answer cache if no function was called.
+        """
+        self._learn_intent(query, rounds)
+        if self.answer_cache is not None and not rounds and response_content and self._is_first_turn(messages) and self.answer_cache.is_cacheable(query):
+            self.answer_cache.set(query, self.tool_manager.get_query_embedding(query), response_content)
+
+    def _add_partial_response(self, messages: List[Dict], reason: str, calls: List[Tuple[Dict, Tuple[object, Optional[Exception]]]] = ()) -> str:
+        """
+        Add a graceful partial answer to the messages when the tool loop runs out of steps or time:
+        an apology with a short summary of the successful function calls of the turn, if any.
+        The failed and timed out calls are left out, and no raw payload is shown: only the scalar fields of the results.
+
+        Args:
+            calls: The (function call, (result, error)) pairs of the turn.
+        """
+        log("warning", f"Tool loop stopped: {reason}")
+        metrics.inc("turn_partial_responses_total", reason=reason)
+        lines = []
+        for function_call, (result, error) in calls:
+            if error is not None or function_call["name"] == FULL_RESULT_FUNCTION:
+                continue
+            arguments = ", ".join(str(value) for value in (function_call.get("parameters") or {}).values() if isinstance(value, (str, int, float)))
+            line = f"- {function_call['name'].replace('_', ' ')}" + (f" ({arguments})" if arguments else "")
+            summary = self._summarize_result(result)
+            lines.append(f"{line}: {summary}" if summary else line)
+        response_content = f"I'm sorry, I couldn't fully complete your request ({reason})."
+        if lines:
+            response_content += " Here is what I found so far:\n" + "\n".join(lines)
         messages.append({
             "role": "assistant",
             "content": response_content
         })
         return response_content
 
+    def _summarize_result(self, result, max_fields: int = 5, max_value_chars: int = 64) -> str:
+        """
+        One-line summary of a function result for a partial answer: its first scalar fields, or its number of items.
+        """
+        def value(item) -> str:
+            item = str(item)
+            return item if len(item) <= max_value_chars else item[:max_value_chars - 3] + "..."
 
-        
+        if isinstance(result, dict):
+            fields = [f"{key}: {value(item)}" for key, item in result.items() if isinstance(item, (str, int, float, bool))]
+            return ", ".join(fields[:max_fields])
+        if isinstance(result, (list, tuple)):
+            return f"{len(result)} items"
+        return "" if result is None else value(result)
+
+    def _record_tokens(self, usage, sent_messages: List[Dict], response_content: str):
+        """
+        Count the prompt and completion tokens of an LLM call, from the usage reported in the response
+        or estimated locally when there is none (streams).
+        """
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens = sum(estimate_message_tokens(message) for message in sent_messages)
+            completion_tokens = estimate_tokens(response_content or "")
+        metrics.inc("llm_prompt_tokens_total", prompt_tokens)
+        metrics.inc("llm_completion_tokens_total", completion_tokens)
+
+    def _get_llm_timeout(self, turn_deadline: float) -> float:
+        """
+        Time left for an LLM call before the deadline of the turn.
+        """
+        return turn_deadline - time.monotonic()
+
+    def _llm_response(self, content: Optional[str], tool_calls: List[Dict], usage=None, streamed: bool = False, error: Exception = None) -> Dict:
+        """
+        Outcome of an LLM call, as sent back to `_run_turn` by the drivers.
+        streamed is True if the content was already shown to the user (a streamed text response, possibly cut by an error).
+        """
+        return {"content": content, "tool_calls": tool_calls, "usage": usage, "streamed": streamed, "error": error}
+
+    def _run_turn(self, messages: List[Dict]) -> Generator[Tuple, object, str]:
+        """
+        The tool loop of a user turn, shared by `generate_response`, `agenerate_response`, `stream_response` and `astream_response`.
+        It does no I/O itself: it yields actions to its driver and receives their outcome, and returns the answer.
+        - ("run", func, args): local blocking work (tool selection, answer cache lookup), the outcome is its return value.
+        - ("call", function_calls, turn_deadline): the function calls of a round, the outcome is their (result, error) pairs.
+        - ("llm", sent_messages, functions_list, turn_deadline): an LLM call, the outcome is an `_llm_response`.
+        The exceptions raised by an action are thrown back into the generator.
+        """
+        if len(messages) == 0:
+            return "No messages provided."
 
-        
\ No newline at end of file
+        answer = yield ("run", self._get_cached_answer, (messages,))
+        if answer is not None:
+            return answer
+
+        turn_deadline = time.monotonic() + self.turn_timeout
+        query = self._get_user_query(messages)
+        rounds = [] # (function calls, results) of each round of function calls
+        calls = [] # (function call, (result, error)) of all the calls of the turn, for a partial answer
+        intent_calls = self._get_intent_calls(messages)
+        if intent_calls:
+            # The call is known from the intent cache: skip the LLM call that would emit it
+            results = yield ("call", intent_calls, turn_deadline)
+            self._add_intent_results(messages, query, intent_calls, results)
+            rounds.append((intent_calls, None))
+            calls.extend(zip(intent_calls, results))
+        for step in range(len(rounds), self.max_tool_steps + 1):
+            functions_list = yield ("run", self._prepare_messages, (messages,))
+
+            if self._get_llm_timeout(turn_deadline) <= 0:
+                return self._add_partial_response(messages, "time limit reached", calls)
+
+            # Generate the LLM response
+            sent_messages = self.context_window.apply(messages)
+            response = yield ("llm", sent_messages, functions_list, turn_deadline)
+            response_content = response["content"]
+            error = response["error"]
+            if isinstance(error, (TimeoutError, asyncio.TimeoutError, _api_timeout_error())):
+                if response["streamed"]: # keep the part of the answer already shown
+                    messages.append({"role": "assistant", "content": response_content})
+                    return response_content
+                return self._add_partial_response(messages, "time limit reached", calls)
+            if error is not None:
+                if step == 0 and not response["streamed"]:
+                    raise error
+                return self._add_error_response(messages, error)
+            self._record_tokens(response["usage"], sent_messages, response_content)
+
+            function_calls = [] if response["streamed"] else self._parse_function_calls(response_content, response["tool_calls"])
+            if not function_calls:
+                # Regular text response
+                self._learn_from_turn(messages, query, rounds, response_content)
+                messages.append({
+                    "role": "assistant",
+                    "content": response_content
+                })
+                return response_content
+
+            if step == self.max_tool_steps:
+                break
+            try:
+                self._add_function_calls(messages, function_calls)
+
+                # Call the functions and add their results to messages. get_full_result is a local read, run in place
+                remote_calls = [call for call in function_calls if call["name"] != FULL_RESULT_FUNCTION]
+                remote_results = iter((yield ("call", remote_calls, turn_deadline)) if remote_calls else [])
+                results = [
+                    self._read_full_result(messages, call["parameters"]) if call["name"] == FULL_RESULT_FUNCTION else next(remote_results)
+                    for call in function_calls
+                ]
+                self._add_function_results(messages, function_calls, results)
+                rounds.append((function_calls, results))
+                calls.extend(zip(function_calls, results))
+            except Exception as e:
+                return self._add_error_response(messages, e)
+
+        return self._add_partial_response(messages, "too many tool calls", calls)
+
+    def _perform(self, action: Tuple):
+        """
+        Perform a "run" or "call" action of `_run_turn` in the calling thread.
+        """
+        if action[0] == "run":
+            return action[1](*action[2])
+        return self._run_function_calls(action[1], action[2])
+
+    async def _aperform(self, action: Tuple):
+        """
+        Perform a "run" or "call" action of `_run_turn` without blocking the event loop.
+        """
+        if action[0] == "run":
+            return await asyncio.to_thread(action[1], *action[2])
+        return await self._arun_function_calls(action[1], action[2])
+
+    def _llm_request(self, sent_messages: List[Dict], functions_list: List[Dict], temperature: float, max_tokens: int, **options) -> Dict:
+        """
+        Arguments of a chat completion request.
+        """
+        return dict(
+            model=self.model_name,
+            messages=sent_messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            tools=functions_list,
+            tool_choice="auto",
+            **options
+        )
+
+    def _deadline_client(self, turn_deadline: float):
+        """
+        Client for a sync LLM call of the turn: the request times out at the deadline of the turn and is not retried
+        (the SDK retries a timed-out request, which would run the call past the deadline).
+        The async calls are cancelled at the deadline, retries included.
+        """
+        return self.client.with_options(max_retries=0, timeout=max(0.0, self._get_llm_timeout(turn_deadline)))
+
+    def _complete(self, sent_messages: List[Dict], functions_list: List[Dict], turn_deadline: float, temperature: float, max_tokens: int) -> Dict:
+        """
+        LLM call of `generate_response`, bounded by the deadline of the turn.
+        """
+        try:
+            with span("llm_call", mode="generate"):
+                response = self._deadline_client(turn_deadline).chat.completions.create(
+                    **self._llm_request(sent_messages, functions_list, temperature, max_tokens)
+                )
+        except Exception as e:
+            return self._llm_response(None, [], error=e)
+        log("debug", lambda: f"LLM raw response:\n {response}")
+        message = response.choices[0].message
+        return self._llm_response(message.content, self._get_tool_calls(message), getattr(response, "usage", None))
+
+    async def _acomplete(self, sent_messages: List[Dict], functions_list: List[Dict], turn_deadline: float, temperature: float, max_tokens: int) -> Dict:
+        """
+        LLM call of `agenerate_response`, cancelled at the deadline of the turn.
+        """
+        try:
+            with span("llm_call", mode="generate"):
+                response = await asyncio.wait_for(
+                    self.async_client.chat.completions.create(**self._llm_request(sent_messages, functions_list, temperature, max_tokens)),
+                    self._get_llm_timeout(turn_deadline)
+                )
+        except Exception as e:
+            return self._llm_response(None, [], error=e)
+        log("debug", lambda: f"LLM raw response:\n {response}")
+        message = response.choices[0].message
+        return self._llm_response(message.content, self._get_tool_calls(message), getattr(response, "usage", None))
+
+    def _stream(self, sent_messages: List[Dict], functions_list: List[Dict], turn_deadline: float, temperature: float, max_tokens: int) -> Generator[str, None, Dict]:
+        """
+        Streamed LLM call of `stream_response`: yields the text deltas once the response is known to be a regular text response,
+        and returns its `_llm_response`. A response that starts like a function call is buffered until complete.
+        A stream still running at the deadline of the turn is closed.
+        """
+        chunks = []
+        tool_calls = {} # native tool call fragments by index
+        streaming = False # True once the response is known to be a regular text response
+        first_chunk = True
+        start = time.perf_counter()
+        try:
+            # The duration of a stream includes the time the caller takes to consume it
+            with span("llm_call", mode="stream"):
+                stream = self._deadline_client(turn_deadline).chat.completions.create(
+                    **self._llm_request(sent_messages, functions_list, temperature, max_tokens, stream=True)
+                )
+                for chunk in stream:
+                    if time.monotonic() > turn_deadline:
+                        stream.close()
+                        raise TimeoutError("turn deadline reached")
+                    if not chunk.choices:
+                        continue
+                    if first_chunk:
+                        first_chunk = False
+                        metrics.observe("llm_first_token_seconds", time.perf_counter() - start)
+                    delta = chunk.choices[0].delta
+                    self._add_tool_call_deltas(tool_calls, delta)
+                    if not delta.content:
+                        continue
+                    chunks.append(delta.content)
+                    if streaming:
+                        yield delta.content
+                    elif not tool_calls and not self._may_be_function_call("".join(chunks)):
+                        streaming = True
+                        yield "".join(chunks)
+        except Exception as e:
+            return self._llm_response("".join(chunks), [], streamed=streaming, error=e)
+        log("debug", lambda: f"LLM streamed response:\n {''.join(chunks)}")
+        return self._llm_response("".join(chunks), [tool_calls[i] for i in sorted(tool_calls)], streamed=streaming)
+
+    async def _astream(self, sent_messages: List[Dict], functions_list: List[Dict], turn_deadline: float, temperature: float, max_tokens: int) -> AsyncIterator:
+        """
+        Async version of `_stream`, built on AsyncOpenAI. Async generators cannot return a value,
+        so the `_llm_response` is yielded last, after the text deltas.
+        """
+        chunks = []
+        tool_calls = {} # native tool call fragments by index
+        streaming = False # True once the response is known to be a regular text response
+        first_chunk = True
+        start = time.perf_counter()
+        try:
+            # The duration of a stream includes the time the caller takes to consume it
+            with span("llm_call", mode="stream"):
+                stream = await asyncio.wait_for(
+                    self.async_client.chat.completions.create(**self._llm_request(sent_messages, functions_list, temperature, max_tokens, stream=True)),
+                    self._get_llm_timeout(turn_deadline)
+                )
+                iterator = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(iterator.__anext__(), turn_deadline - time.monotonic())
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        if hasattr(stream, "close"):
+                            await stream.close()
+                        raise
+                    if not chunk.choices:
+                        continue
+                    if first_chunk:
+                        first_chunk = False
+                        metrics.observe("llm_first_token_seconds", time.perf_counter() - start)
+                    delta = chunk.choices[0].delta
+                    self._add_tool_call_deltas(tool_calls, delta)
+                    if not delta.content:
+                        continue
+                    chunks.append(delta.content)
+                    if streaming:
+                        yield delta.content
+                    elif not tool_calls and not self._may_be_function_call("".join(chunks)):
+                        streaming = True
+                        yield "".join(chunks)
+        except Exception as e:
+            yield self._llm_response("".join(chunks), [], streamed=streaming, error=e)
+            return
+        log("debug", lambda: f"LLM streamed response:\n {''.join(chunks)}")
+        yield self._llm_response("".join(chunks), [tool_calls[i] for i in sorted(tool_calls)], streamed=streaming)
+
+    def generate_response(self, messages: List[Dict], temperature: float = 0.6, max_tokens: int = 512):
+        """
+        Generate a response from the LLM, handling function calls if necessary.
+        The LLM is re-called with the tool results when tools are called, in a loop of at most max_tool_steps tool rounds
+        and turn_timeout seconds; past that, a partial answer is returned. Every step uses the same generation parameters.
+        The function calls of one response run concurrently and all their results are sent back in a single request.
+
+        Args:
+            messages: The conversation history as a list of messages.
+            temperature: Sampling temperature for the LLM.
+            max_tokens: Maximum number of tokens to generate.
+
+        Returns:
+            The LLM's response content.
+        """
+        turn = self._run_turn(messages)
+        outcome, error = None, None
+        while True:
+            try:
+                action = turn.send(outcome) if error is None else turn.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            outcome, error = None, None
+            try:
+                if action[0] == "llm":
+                    outcome = self._complete(*action[1:], temperature, max_tokens)
+                else:
+                    outcome = self._perform(action)
+            except Exception as e:
+                error = e
+
+    async def agenerate_response(self, messages: List[Dict], temperature: float = 0.6, max_tokens: int = 512):
+        """
+        Async version of `generate_response`, built on AsyncOpenAI.
+        The tool selection and the function calls run in worker threads so the event loop is never blocked.
+        The LLM call or function calls in flight when the deadline of the turn passes are cancelled.
+
+        Args:
+            messages: The conversation history as a list of messages.
+            temperature: Sampling temperature for the LLM.
+            max_tokens: Maximum number of tokens to generate.
+
+        Returns:
+            The LLM's response content.
+        """
+        turn = self._run_turn(messages)
+        outcome, error = None, None
+        while True:
+            try:
+                action = turn.send(outcome) if error is None else turn.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            outcome, error = None, None
+            try:
+                if action[0] == "llm":
+                    outcome = await self._acomplete(*action[1:], temperature, max_tokens)
+                else:
+                    outcome = await self._aperform(action)
+            except Exception as e:
+                error = e
+
+    def stream_response(self, messages: List[Dict], temperature: float = 0.6, max_tokens: int = 512) -> Iterator[str]:
+        """
+        Streaming version of `generate_response`: yields the text deltas of the final answer as they arrive.
+        A response that starts like a function call is buffered until complete; if it is one, the functions are called
+        and the answer to the tool results is streamed. Any other response is streamed as a regular text response.
+        The same step budget and deadline as `generate_response` apply; a stream still running at the deadline is closed.
+
+        Args:
+            messages: The conversation history as a list of messages.
+            temperature: Sampling temperature for the LLM.
+            max_tokens: Maximum number of tokens to generate.
+
+        Yields:
+            The text deltas of the LLM's response.
+        """
+        turn = self._run_turn(messages)
+        outcome, error = None, None
+        shown = "" # text of the answer already yielded
+        while True:
+            try:
+                action = turn.send(outcome) if error is None else turn.throw(error)
+            except StopIteration as stop:
+                answer = stop.value
+                # Yield what was not streamed yet: the whole answer, unless it is the text response just streamed
+                remainder = answer[len(shown):] if answer and answer.startswith(shown) else answer
+                if remainder:
+                    yield remainder
+                return
+            outcome, error = None, None
+            try:
+                if action[0] == "llm":
+                    outcome = yield from self._stream(*action[1:], temperature, max_tokens)
+                    shown = outcome["content"] if outcome["streamed"] else ""
+                else:
+                    outcome = self._perform(action)
+            except Exception as e:
+                error = e
+
+    async def astream_response(self, messages: List[Dict], temperature: float = 0.6, max_tokens: int = 512) -> AsyncIterator[str]:
+        """
+        Async version of `stream_response`, built on AsyncOpenAI.
+
+        Args:
+            messages: The conversation history as a list of messages.
+            temperature: Sampling temperature for the LLM.
+            max_tokens: Maximum number of tokens to generate.
+
+        Yields:
+            The text deltas of the LLM's response.
+        """
+        turn = self._run_turn(messages)
+        outcome, error = None, None
+        shown = "" # text of the answer already yielded
+        while True:
+            try:
+                action = turn.send(outcome) if error is None else turn.throw(error)
+            except StopIteration as stop:
+                answer = stop.value
+                # Yield what was not streamed yet: the whole answer, unless it is the text response just streamed
+                remainder = answer[len(shown):] if answer and answer.startswith(shown) else answer
+                if remainder:
+                    yield remainder
+                return
+            outcome, error = None, None
+            try:
+                if action[0] == "llm":
+                    async for item in self._astream(*action[1:], temperature, max_tokens):
+                        if isinstance(item, dict):
+                            outcome = item
+                        else:
+                            yield item
+                    shown = outcome["content"] if outcome["streamed"] else ""
+                else:
+                    outcome = await self._aperform(action)
+            except Exception as e:
+                error = e
@@ -0,0 +1,188 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict
+from telemetry import log
+
+
+class SessionStore:
+    """
+    Bounded in-memory store of chat sessions.
+    Sessions are evicted in LRU order when there are more than max_sessions of them or when their estimated
+    total size exceeds max_bytes, and after idle_ttl seconds without activity (checked by a background sweeper).
+    With a backend (e.g. a SQLiteCache), evicted sessions are saved and lazily restored on their next access.
+    """
+    def __init__(self, create: Callable[[], Any], dump: Callable[[Any], Dict] = None, load: Callable[[Dict], Any] = None,
+                 size: Callable[[Any], int] = None, max_sessions: int = 1000, idle_ttl: float = 3600, max_bytes: int = None,
+                 backend=None, sweep_interval: float = 60):
+        """
+        Args:
+            create: Create a new session.
+            dump: Serialize a session to a JSON-serializable dictionary (required with a backend).
+            load: Restore a session from its serialized dictionary (required with a backend).
+            size: Estimate the size of a session in bytes (required with max_bytes).
+            max_sessions: Maximum number of sessions kept in memory.
+            idle_ttl: Seconds without activity after which a session is evicted (never if None).
+            max_bytes: Maximum estimated total size of the sessions kept in memory (no limit if None).
+            backend: Store of the evicted sessions, with the get/set/delete interface of the caches. No restore if None.
+            sweep_interval: Seconds between two sweeps of the idle sessions by the background sweeper.
+        """
+        if backend is not None and (dump is None or load is None):
+            raise ValueError("dump and load are required to use a session backend.")
+        if max_bytes is not None and size is None:
+            raise ValueError("size is required to use a byte budget.")
+        self.create = create
+        self.dump = dump
+        self.load = load
+        self.size = size
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.sweep_interval = sweep_interval
+        self.evictions = 0
+        self.restores = 0
+        self._sessions: "OrderedDict[str, Any]" = OrderedDict() # session id -> session, least recently used first
+        self._last_access: Dict[str, float] = {}
+        self._sizes: Dict[str, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        self._sweeper = None
+        self._stop_sweeper = threading.Event()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def get_or_create(self, session_id: str) -> Any:
+        """
+        Get a session, restoring it from the backend or creating it if it is not in memory.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._restore(session_id)
+                if session is None:
+                    session = self.create()
+                self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            self._last_access[session_id] = time.monotonic()
+            self._enforce_limits(keep=session_id)
+            return session
+
+    def touch(self, session_id: str):
+        """
+        Mark a session as active and update its estimated size (e.g. after a turn of conversation).
+        """
+        with self._lock:
+            if session_id not in self._sessions:
+                return
+            self._sessions.move_to_end(session_id)
+            self._last_access[session_id] = time.monotonic()
+            if self.size is not None:
+                size = self.size(self._sessions[session_id])
+                self._total_bytes += size - self._sizes.get(session_id, 0)
+                self._sizes[session_id] = size
+            self._enforce_limits(keep=session_id)
+
+    def delete(self, session_id: str):
+        """
+        Delete a session from memory and from the backend.
+        """
+        with self._lock:
+            self._remove(session_id)
+            if self.backend is not None:
+                self.backend.delete(session_id)
+
+    def sweep(self) -> int:
+        """
+        Evict the sessions idle for more than idle_ttl seconds.
+
+        Returns:
+            The number of evicted sessions.
+        """
+        if self.idle_ttl is None:
+            return 0
+        deadline = time.monotonic() - self.idle_ttl
+        with self._lock:
+            idle = [session_id for session_id, last_access in self._last_access.items() if last_access < deadline]
+            for session_id in idle:
+                self._evict(session_id)
+            return len(idle)
+
+    def start_sweeper(self):
+        """
+        Start the background thread that evicts the idle sessions every sweep_interval seconds.
+        """
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        self._stop_sweeper.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop_sweeper.set()
+
+    def _sweep_loop(self):
+        while not self._stop_sweeper.wait(self.sweep_interval):
+            evicted = self.sweep()
+            if evicted:
+                log("info", f"Evicted {evicted} idle sessions, {len(self)} left")
+
+    def _enforce_limits(self, keep: str = None):
+        """
+        Evict the least recently used sessions (except keep) until the limits are respected.
+        """
+        for session_id in list(self._sessions):
+            over_count = len(self._sessions) > self.max_sessions
+            over_bytes = self.max_bytes is not None and self._total_bytes > self.max_bytes
+            if not (over_count or over_bytes):
+                break
+            if session_id != keep:
+                self._evict(session_id)
+
+    def _evict(self, session_id: str):
+        """
+        Remove a session from memory, saving it to the backend if there is one.
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            return
+        if self.backend is not None:
+            self.backend.set(session_id, self.dump(session))
+        self._remove(session_id)
+        self.evictions += 1
+
+    def _remove(self, session_id: str):
+        self._sessions.pop(session_id, None)
+        self._last_access.pop(session_id, None)
+        self._total_bytes -= self._sizes.pop(session_id, 0)
+
+    def _restore(self, session_id: str) -> Any:
+        """
+        Restore an evicted session from the backend (None if there is no backend or the session is unknown).
+        """
+        if self.backend is None:
+            return None
+        data = self.backend.get(session_id)
+        if data is None:
+            return None
+        session = self.load(data)
+        if self.size is not None:
+            self._sizes[session_id] = self.size(session)
+            self._total_bytes += self._sizes[session_id]
+        self.restores += 1
+        return session
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Number of sessions in memory, their estimated size, and the eviction/restore counters.
+        """
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._total_bytes,
+            "evictions": self.evictions,
+            "restores": self.restores,
+        }
@@ -0,0 +1,84 @@
+import json
+from typing import Any, Dict, List, Tuple
+
+
+def compact_json(value: Any) -> str:
+    """
+    Serialize a value to JSON without whitespace.
+    """
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def _field_tree(fields: List[str]) -> Dict:
+    """
+    Build a projection tree from dotted field paths: ["a", "b.c", "b.d"] -> {"a": None, "b": {"c": None, "d": None}}.
+    None means that the whole value is kept.
+    """
+    tree = {}
+    for field in fields:
+        node = tree
+        parts = field.split(".")
+        for part in parts[:-1]:
+            if node.get(part, {}) is None: # the parent is already kept whole
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+class ResultShaper:
+    """
+    Shape the result of a tool before it is fed to the LLM: field projection, list truncation with counts
+    and numeric rounding. Declared per tool at registration time.
+    """
+    def __init__(self, fields: List[str] = None, max_items: int = None, decimals: int = None):
+        """
+        Args:
+            fields: Dotted paths of the fields to keep (e.g. ["nativeBalance", "tokens.symbol", "tokens.amount"]).
+                    Projections apply to every item of the lists they go through. All the fields are kept if None.
+            max_items: Maximum number of items kept in a list; the rest is replaced by a count. No limit if None.
+            decimals: Number of decimals floats are rounded to. No rounding if None.
+        """
+        self.fields = _field_tree(fields) if fields else None
+        self.max_items = max_items
+        self.decimals = decimals
+
+    def with_max_items(self, max_items: int) -> "ResultShaper":
+        """
+        A copy of the shaper that keeps at most max_items items per list (fewer if this shaper already keeps fewer).
+        """
+        shaper = ResultShaper(max_items=max_items if self.max_items is None else min(max_items, self.max_items), decimals=self.decimals)
+        shaper.fields = self.fields
+        return shaper
+
+    def __call__(self, result: Any) -> Tuple[Any, bool]:
+        """
+        Shape a result.
+
+        Returns:
+            The shaped result, and whether information was dropped (fields or list items).
+        """
+        state = {"dropped": False} # per call, the shaper is shared by concurrent tool calls
+        shaped = self._shape(result, self.fields, state)
+        return shaped, state["dropped"]
+
+    def _shape(self, value: Any, tree: Dict, state: Dict) -> Any:
+        if isinstance(value, dict):
+            if tree is not None:
+                if any(key not in tree for key in value):
+                    state["dropped"] = True
+                return {key: self._shape(value[key], tree[key], state) for key in tree if key in value}
+            return {key: self._shape(item, None, state) for key, item in value.items()}
+        if isinstance(value, list):
+            items = value
+            if self.max_items is not None and len(value) > self.max_items:
+                state["dropped"] = True
+                items = value[:self.max_items]
+            shaped = [self._shape(item, tree, state) for item in items]
+            if len(items) < len(value):
+                shaped.append(f"... {len(value) - len(items)} more items ({len(value)} in total)")
+            return shaped
+        if isinstance(value, float) and self.decimals is not None:
+            return round(value, self.decimals)
+        return value
@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+import numpy as np
+from cache import file_lock
+from telemetry import log
+from tools import ToolIndex
+
+
+MANIFEST_FILE = "manifest.json"
+
+
+class SharedToolIndex:
+    """
+    Tool index shared by several worker processes through memory-mapped files.
+    The embedding matrix (in the storage dtype of `ToolIndex`) and the name table are published once
+    in a directory as a numbered version; every process maps the files read-only, so the pages are shared
+    through the OS page cache and the memory per worker stays flat as the number of workers grows.
+
+    Adding tools publishes a new version (under a file lock) and atomically replaces the manifest;
+    the other processes check the manifest at most every refresh_interval seconds and swap to the new version
+    in a single step, in-flight searches finish on the previous one. Adding tools that are already published
+    with the same embeddings publishes nothing, so every worker can run the same registration code.
+    """
+    def __init__(self, directory: str, dtype: str = "float32", refresh_interval: float = 1.0, keep_versions: int = 2):
+        """
+        Args:
+            directory: Directory of the published index files.
+            dtype: Storage of the embeddings: float32, float16 or int8 (see `ToolIndex`).
+            refresh_interval: Minimum number of seconds between two checks of the manifest for a new version.
+            keep_versions: Number of published versions kept on disk (the older ones are deleted).
+        """
+        if dtype not in ToolIndex.DTYPES:
+            raise ValueError(f"Unknown dtype '{dtype}', expected one of {', '.join(ToolIndex.DTYPES)}.")
+        self.directory = directory
+        self.dtype = dtype
+        self.refresh_interval = refresh_interval
+        self.keep_versions = keep_versions
+        self.version = 0
+        self._index = ToolIndex(dtype=dtype) # current version, replaced as a whole
+        self._manifest_path = os.path.join(directory, MANIFEST_FILE)
+        self._manifest_mtime = None
+        self._last_check = 0.0
+        self._lock = threading.Lock() # swaps of the current version
+        self._publishing = threading.Lock() # publishers of this process (the file lock serializes the processes)
+        os.makedirs(directory, exist_ok=True)
+        self.refresh(force=True)
+
+    # Read-only interface of ToolIndex, served by the current version
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    @property
+    def names(self) -> List[str]:
+        return self._index.names
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._index.matrix
+
+    @property
+    def nbytes(self) -> int:
+        return self._index.nbytes
+
+    def get(self, name: str) -> np.ndarray:
+        return self._index.get(name)
+
+    def scores(self, query_embedding: np.ndarray) -> np.ndarray:
+        self.refresh()
+        return self._index.scores(query_embedding)
+
+    def search(self, query_embedding: np.ndarray, top_n: int = 5, similarity_threshold: float = 0.2) -> List[Tuple[str, float]]:
+        self.refresh()
+        return self._index.search(query_embedding, top_n, similarity_threshold)
+
+    def refresh(self, force: bool = False):
+        """
+        Swap to the latest published version if there is a new one.
+        The manifest is checked at most every refresh_interval seconds unless force is True.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_check < self.refresh_interval:
+            return
+        self._last_check = now
+        try:
+            mtime = os.stat(self._manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._manifest_mtime:
+            return
+        with self._lock:
+            try:
+                with open(self._manifest_path, "r") as f:
+                    manifest = json.load(f)
+                if manifest["version"] != self.version:
+                    self._index = self._load(manifest)
+                    self.version = manifest["version"]
+                    log("info", f"Attached shared tool index v{self.version}: {len(self._index)} tools")
+                self._manifest_mtime = mtime
+            except (OSError, ValueError, KeyError) as e: # e.g. the files of the version were already deleted
+                log("warning", f"Could not attach the shared tool index in {self.directory}: {e}")
+
+    def _paths(self, version: int) -> Tuple[str, str, str]:
+        base = os.path.join(self.directory, f"tools-v{version:08d}")
+        return f"{base}.matrix", f"{base}.scales", f"{base}.names.json"
+
+    def _load(self, manifest: dict) -> ToolIndex:
+        """
+        Map the files of a published version read-only.
+        """
+        if manifest["dtype"] != self.dtype:
+            raise ValueError(f"the published index is {manifest['dtype']}, expected {self.dtype}")
+        matrix_path, scales_path, names_path = self._paths(manifest["version"])
+        with open(names_path, "r") as f:
+            names = json.load(f)
+        if not names:
+            return ToolIndex(dtype=self.dtype)
+        shape = (len(names), manifest["dim"])
+        matrix = np.memmap(matrix_path, dtype=self.dtype, mode="r", shape=shape)
+        scales = np.memmap(scales_path, dtype=np.float32, mode="r", shape=(len(names),)) if self.dtype == "int8" else None
+        return ToolIndex.from_arrays(names, matrix, scales)
+
+    @contextmanager
+    def _publish_lock(self):
+        with self._publishing, file_lock(os.path.join(self.directory, "publish.lock")):
+            yield
+
+    def _is_published(self, names: List[str], embeddings: np.ndarray) -> bool:
+        """
+        Check if the tools are already published with the same embeddings (after quantization).
+        """
+        current = self._index
+        if not all(name in current for name in names):
+            return False
+        candidate = ToolIndex(dtype=self.dtype)
+        candidate.add_many(names, embeddings)
+        rows = np.array([current._positions[name] for name in candidate.names])
+        return np.allclose(candidate.rows(slice(0, len(candidate))), current.rows(rows), atol=1e-6)
+
+    def add_many(self, names: List[str], embeddings: np.ndarray):
+        """
+        Add several tool embeddings and publish the result as a new version, unless they are already published.
+        """
+        if len(names) == 0:
+            return
+        with self._publish_lock():
+            self.refresh(force=True) # another process may have published since the last check
+            if self._is_published(names, embeddings):
+                return
+
+            current = self._index
+            count = len(current)
+            index = ToolIndex.from_arrays(
+                current.names,
+                np.array(current._matrix[:count]) if count else np.zeros((0, np.atleast_2d(embeddings).shape[1]), dtype=self.dtype),
+                np.array(current._scales[:count]) if current._scales is not None else (np.zeros(0, dtype=np.float32) if self.dtype == "int8" else None),
+            )
+            index.add_many(names, embeddings)
+
+            version = self.version + 1
+            matrix_path, scales_path, names_path = self._paths(version)
+            np.ascontiguousarray(index._matrix[:len(index)]).tofile(matrix_path)
+            if index._scales is not None:
+                np.ascontiguousarray(index._scales[:len(index)]).tofile(scales_path)
+            with open(names_path, "w") as f:
+                json.dump(index.names, f)
+            manifest = {"version": version, "dtype": self.dtype, "dim": index._matrix.shape[1], "count": len(index)}
+            tmp_path = f"{self._manifest_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self._manifest_path)
+
+            with self._lock:
+                self._index = self._load(manifest)
+                self.version = version
+                self._manifest_mtime = os.stat(self._manifest_path).st_mtime_ns
+            self._delete_old_versions()
+            log("info", f"Published shared tool index v{version}: {len(index)} tools")
+
+    def add(self, name: str, embedding: np.ndarray):
+        self.add_many([name], np.asarray(embedding)[None, :])
+
+    def _delete_old_versions(self):
+        """
+        Delete the files of the versions older than the keep_versions latest ones.
+        Processes that still map them keep a valid mapping (the data is freed when they swap).
+        """
+        for path in self._paths(self.version - self.keep_versions):
+            if os.path.exists(path):
+                os.remove(path)
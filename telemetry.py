@@ -0,0 +1,265 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple, Union
+
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40, "off": 100}
+
+# Latency buckets of the histograms, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_log_level = LOG_LEVELS.get(os.getenv("LOG_LEVEL", "info").lower(), LOG_LEVELS["info"])
+
+
+def set_log_level(level: str):
+    """
+    Set the log level: debug, info, warning, error or off.
+    """
+    global _log_level
+    if level.lower() not in LOG_LEVELS:
+        raise ValueError(f"Unknown log level '{level}', expected one of {', '.join(LOG_LEVELS)}.")
+    _log_level = LOG_LEVELS[level.lower()]
+
+
+def log_enabled(level: str) -> bool:
+    return LOG_LEVELS[level] >= _log_level
+
+
+def log(level: str, message: Union[str, Callable[[], str]]):
+    """
+    Print a log message if its level is enabled.
+    The message can be a function that builds it, so verbose dumps cost nothing when their level is disabled.
+    """
+    if LOG_LEVELS[level] < _log_level:
+        return
+    if callable(message):
+        message = message()
+    print(f"#### {message} \n####")
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Dict[str, str] = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values (Prometheus style buckets).
+    """
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets) # observations per bucket (not cumulative)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in (inf past the last bucket).
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """
+    Process-wide metrics: counters, latency histograms and gauges read from collectors
+    (e.g. the hit rates of the caches). Exported as Prometheus text or as JSON.
+    """
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters: Dict[str, Dict[tuple, float]] = {} # name -> labels -> value
+        self._histograms: Dict[str, Dict[tuple, Histogram]] = {} # name -> labels -> histogram
+        self._collectors: Dict[str, Callable[[], Dict]] = {} # gauge prefix -> collector
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Increment a counter.
+        """
+        key = _label_key(labels)
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Add an observation to a histogram.
+        """
+        key = _label_key(labels)
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            if key not in histograms:
+                histograms[key] = Histogram(self.buckets)
+            histograms[key].observe(value)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """
+        Time a block of code: its latency goes to the {name}_seconds histogram
+        and its errors to the {name}_errors_total counter.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name}_errors_total", **labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(f"{name}_seconds", elapsed, **labels)
+            log("debug", lambda: f"Span {name}{_format_labels(_label_key(labels))}: {elapsed * 1000:.1f} ms")
+
+    def register_collector(self, prefix: str, collector: Callable[[], Dict]):
+        """
+        Register a function read at export time. It returns {stat: value} (exported as {prefix}_{stat} gauges)
+        or {label: {stat: value}} (exported with a name=label label), e.g. the `stats()` of a cache.
+        """
+        with self._lock:
+            self._collectors[prefix] = collector
+
+    def _collect(self) -> List[Tuple[str, tuple, float]]:
+        with self._lock:
+            collectors = list(self._collectors.items())
+        gauges = []
+        for prefix, collector in collectors:
+            try:
+                stats = collector()
+            except Exception as e:
+                log("warning", f"Metrics collector {prefix} failed: {e}")
+                continue
+            for key, value in stats.items():
+                items = value.items() if isinstance(value, dict) else [(key, value)]
+                labels = (("name", str(key)),) if isinstance(value, dict) else ()
+                for stat, number in items:
+                    if isinstance(number, (int, float)):
+                        gauges.append((f"{prefix}_{stat}", labels, number))
+        return gauges
+
+    def snapshot(self) -> Dict:
+        """
+        All the metrics as a JSON-serializable dictionary.
+        """
+        with self._lock:
+            counters = {
+                name: [{"labels": dict(key), "value": value} for key, value in values.items()]
+                for name, values in self._counters.items()
+            }
+            histograms = {
+                name: [
+                    {
+                        "labels": dict(key),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                        "p50": histogram.quantile(0.5),
+                        "p95": histogram.quantile(0.95),
+                        "p99": histogram.quantile(0.99),
+                    }
+                    for key, histogram in values.items()
+                ]
+                for name, values in self._histograms.items()
+            }
+        gauges = {}
+        for name, labels, value in self._collect():
+            gauges.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def prometheus(self) -> str:
+        """
+        All the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, values in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f"{name}{_format_labels(key)} {value}" for key, value in values.items())
+            for name, values in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in values.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, {'le': bound})} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(key, {'le': '+Inf'})} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        typed = set()
+        for name, labels, value in self._collect():
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+# Shared metrics for the whole process
+metrics = Metrics()
+
+
+def span(name: str, **labels):
+    """
+    Time a block of code with the process-wide metrics. See `Metrics.span`.
+    """
+    return metrics.span(name, **labels)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body, content_type = metrics.prometheus(), "text/plain; version=0.0.4"
+        elif path == "/metrics.json":
+            body, content_type = json.dumps(metrics.snapshot()), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log("debug", lambda: f"Metrics request: {format % args}")
+
+
+def serve_metrics(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """
+    Serve the metrics in a background thread: Prometheus text on /metrics, JSON on /metrics.json.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    log("info", f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -1,15 +1,542 @@
-from typing import Dict
-from sklearn.metrics.pairwise import cosine_similarity
-from openai import OpenAI
-from sentence_transformers import SentenceTransformer
+import json
+import math
+import re
+import sys
+from collections import Counter
+from typing import Dict, List, Set, Tuple
+import numpy as np
+from cache import LRUCache
+from embeddings import DEFAULT_MODEL_NAME, EmbeddingCache, get_model
+from telemetry import log, metrics, span
+
+
+# Solana addresses: base58 strings of 32 to 44 characters
+ADDRESS_PATTERN = re.compile(r"\b[1-9A-HJ-NP-Za-km-z]{32,44}\b")
+_WORD_PATTERN = re.compile(r"[A-Z]{2,}s(?![a-z])|[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+") # NFTs, getTokenPrice, get_token_price
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from get give how i in is it me my of on or please show tell "
+    "that the this to want what when which who with you your".split()
+)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    L2-normalize a vector or the rows of a matrix, so that cosine similarity becomes a dot product.
+    Zero vectors are left untouched.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a text into lowercase terms for the lexical index: snake_case and camelCase words are split,
+    stopwords are dropped and plurals are reduced (prices -> price), so that "price" matches get_token_price.
+    Addresses are removed (see ADDRESS_PATTERN).
+    """
+    terms = []
+    for word in _WORD_PATTERN.findall(ADDRESS_PATTERN.sub(" ", text)):
+        word = word.lower()
+        if word in STOPWORDS:
+            continue
+        if word.endswith("sses"):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the tool names, descriptions and parameter names.
+    The name terms are counted name_weight times, since a query term matching the name is the strongest signal.
+    The BM25 contribution of each term to each tool is precomputed into arrays on the first query after a change,
+    so a query is a few vectorized additions.
+    Terms found in more than half of the tools (idf below min_idf, e.g. "solana", "network") do not score: they match
+    almost any tool and say nothing about the one the query needs.
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75, name_weight: int = 2, min_idf: float = math.log(2)):
+        self.k1 = k1
+        self.b = b
+        self.name_weight = name_weight
+        self.min_idf = min_idf
+        self.names: List[str] = [] # tool names, parallel to the score arrays
+        self._positions: Dict[str, int] = {} # tool name -> position in names
+        self._terms: List[Counter] = [] # position -> term frequencies
+        self._name_terms: List[Set[str]] = [] # position -> terms of the name
+        self._postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = None # term -> (positions, BM25 contributions)
+        self._idf: Dict[str, float] = {} # term -> idf, of all the indexed terms
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def add(self, name: str, description: str = "", parameter_names: List[str] = ()):
+        """
+        Index a tool, replacing it if it is already indexed.
+        """
+        name_terms = tokenize(name)
+        terms = Counter(name_terms * self.name_weight + tokenize(description) + tokenize(" ".join(parameter_names)))
+        if name not in self._positions:
+            self._positions[name] = len(self.names)
+            self.names.append(name)
+            self._terms.append(terms)
+            self._name_terms.append(set(name_terms))
+        else:
+            position = self._positions[name]
+            self._terms[position] = terms
+            self._name_terms[position] = set(name_terms)
+        self._postings = None
+
+    def _compile(self) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Precompute the BM25 contribution of every term to every tool that contains it.
+        """
+        lengths = np.array([sum(terms.values()) for terms in self._terms], dtype=np.float32)
+        average_length = lengths.mean() if len(lengths) else 0.0
+        frequencies: Dict[str, Tuple[List[int], List[int]]] = {}
+        for position, terms in enumerate(self._terms):
+            for term, frequency in terms.items():
+                positions, counts = frequencies.setdefault(term, ([], []))
+                positions.append(position)
+                counts.append(frequency)
+        postings = {}
+        self._idf = {}
+        for term, (positions, counts) in frequencies.items():
+            idf = self._term_idf(len(positions))
+            self._idf[term] = idf
+            if idf < self.min_idf:
+                continue
+            positions = np.array(positions, dtype=np.int64)
+            counts = np.array(counts, dtype=np.float32)
+            norm = counts + self.k1 * (1 - self.b + self.b * lengths[positions] / average_length)
+            postings[term] = (positions, (idf * counts * (self.k1 + 1) / norm).astype(np.float32))
+        return postings
+
+    def _term_idf(self, document_frequency: int) -> float:
+        return math.log(1 + (len(self.names) - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def position(self, name: str) -> int:
+        return self._positions[name]
+
+    def max_score(self, query_terms: List[str]) -> float:
+        """
+        Upper bound of the BM25 score for the query terms: the sum of idf * (k1 + 1) over the scoring terms.
+        Dividing by it puts the scores on a scale that does not depend on the best match of the query: a query only
+        sharing a weak term with the tools stays close to 0 instead of being stretched to 1.
+        The terms that no tool contains count with the highest idf, since the query asks for something else too.
+        """
+        if self._postings is None:
+            self._postings = self._compile()
+        bound = 0.0
+        for term in set(query_terms):
+            idf = self._idf.get(term, self._term_idf(0))
+            if idf >= self.min_idf:
+                bound += idf * (self.k1 + 1)
+        return bound
+
+    def scores(self, query_terms: List[str]) -> np.ndarray:
+        """
+        BM25 scores of all the tools for the query terms (0 for the tools without any of the terms), parallel to names.
+        """
+        if self._postings is None:
+            self._postings = self._compile()
+        scores = np.zeros(len(self.names), dtype=np.float32)
+        for term in set(query_terms):
+            posting = self._postings.get(term)
+            if posting is not None:
+                scores[posting[0]] += posting[1]
+        return scores
+
+    def top(self, scores: np.ndarray, top_n: int) -> List[str]:
+        """
+        The names of the top N tools with a positive score, ordered by decreasing score.
+        """
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_n:
+            candidates = candidates[np.argpartition(-scores[candidates], top_n - 1)[:top_n]]
+        candidates = candidates[np.lexsort((candidates, -scores[candidates]))]
+        return [self.names[i] for i in candidates]
+
+    def name_matches(self, query_terms: List[str], candidates: List[str]) -> List[str]:
+        """
+        The candidate tools whose name terms all appear in the query (e.g. "token price of ..." for get_token_price).
+        """
+        query_terms = set(query_terms)
+        return [
+            name for name in candidates
+            if self._name_terms[self._positions[name]] and self._name_terms[self._positions[name]] <= query_terms
+        ]
+
+
+SCORE_BLOCK_ROWS = 512 # rows of a quantized matrix converted and scored at a time (stays in the CPU cache)
+
+
+class ToolIndex:
+    """
+    Exact similarity index over the tool embeddings.
+    The embeddings are kept pre-normalized in one contiguous matrix, with a parallel list of (interned) tool names
+    (row i of the matrix is the embedding of names[i]).
+
+    The matrix can be stored quantized to shrink the index: float16 (2x smaller), or int8 with one float32 scale
+    per row (about 4x smaller). Quantized rows are scored block by block, without materializing a float32 copy.
+    int8 scoring runs at about the speed of float32; float16 is slower, since converting it is costly in numpy.
+    """
+    DTYPES = ("float32", "float16", "int8")
+
+    def __init__(self, initial_capacity: int = 16, dtype: str = "float32"):
+        """
+        Args:
+            initial_capacity: Number of rows allocated for the first embeddings.
+            dtype: Storage of the embeddings: float32, float16 or int8.
+        """
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unknown dtype '{dtype}', expected one of {', '.join(self.DTYPES)}.")
+        self.dtype = dtype
+        self.names: List[str] = [] # tool names, parallel to the matrix rows
+        self._positions: Dict[str, int] = {} # tool name -> row in the matrix
+        self._matrix = None # (capacity, dim) buffer, only the first len(self) rows are used
+        self._scales = None # (capacity,) scales of the int8 rows
+        self._initial_capacity = initial_capacity
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    @classmethod
+    def from_arrays(cls, names: List[str], matrix: np.ndarray, scales: np.ndarray = None) -> "ToolIndex":
+        """
+        Build an index over existing arrays (e.g. memory-mapped) without copying them.
+        The rows of matrix must already be normalized, and quantized with their scales for int8.
+        """
+        index = cls(dtype=np.dtype(matrix.dtype).name)
+        index.names = [sys.intern(name) for name in names]
+        index._positions = {name: row for row, name in enumerate(index.names)}
+        index._matrix = matrix
+        index._scales = scales
+        return index
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """
+        The (n_tools, dim) matrix of normalized embeddings: a view with float32 storage,
+        a dequantized float32 copy otherwise.
+        """
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        if self.dtype == "float32":
+            return self._matrix[:len(self.names)]
+        return self.rows(slice(0, len(self.names)))
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory used by the embeddings of the indexed tools (scales included).
+        """
+        if self._matrix is None:
+            return 0
+        row_bytes = self._matrix.shape[1] * self._matrix.itemsize + (4 if self._scales is not None else 0)
+        return len(self.names) * row_bytes
+
+    def rows(self, rows) -> np.ndarray:
+        """
+        Get the normalized embeddings of some rows (array of indices or slice) as a float32 matrix.
+        """
+        matrix = self._matrix[rows].astype(np.float32, copy=False)
+        if self._scales is not None:
+            matrix = matrix * self._scales[rows][:, None]
+        return matrix
+
+    def get(self, name: str) -> np.ndarray:
+        """
+        Get the normalized embedding of a tool.
+        """
+        return self.rows(np.array([self._positions[name]]))[0]
+
+    def _reserve(self, n_rows: int, dim: int):
+        """
+        Make sure the buffer can hold n_rows rows, growing it geometrically so that appends stay amortized O(1).
+        """
+        if self._matrix is None:
+            capacity = max(self._initial_capacity, n_rows)
+            self._matrix = np.zeros((capacity, dim), dtype=self.dtype)
+            self._scales = np.zeros(capacity, dtype=np.float32) if self.dtype == "int8" else None
+            return
+        if self._matrix.shape[1] != dim:
+            raise ValueError(f"Embedding dimension {dim} does not match the index dimension {self._matrix.shape[1]}.")
+        if n_rows > self._matrix.shape[0]:
+            capacity = max(n_rows, 2 * self._matrix.shape[0])
+            matrix = np.zeros((capacity, dim), dtype=self.dtype)
+            matrix[:len(self.names)] = self._matrix[:len(self.names)]
+            self._matrix = matrix
+            if self._scales is not None:
+                scales = np.zeros(capacity, dtype=np.float32)
+                scales[:len(self.names)] = self._scales[:len(self.names)]
+                self._scales = scales
+
+    def add(self, name: str, embedding: np.ndarray):
+        """
+        Add a tool embedding to the index, replacing it if the tool is already indexed.
+        """
+        self.add_many([name], np.asarray(embedding)[None, :])
+
+    def add_many(self, names: List[str], embeddings: np.ndarray):
+        """
+        Add several tool embeddings to the index in one step.
+
+        Args:
+            names: The tool names.
+            embeddings: A (len(names), dim) matrix of embeddings, in the same order as names.
+        """
+        if len(names) == 0:
+            return
+        embeddings = normalize(np.atleast_2d(embeddings))
+        if embeddings.shape[0] != len(names):
+            raise ValueError("The number of names and embeddings must match.")
+        new_names = [name for name in dict.fromkeys(names) if name not in self._positions]
+        self._reserve(len(self.names) + len(new_names), embeddings.shape[1])
+        for name in new_names:
+            self._positions[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        rows = [self._positions[name] for name in names]
+        # with duplicated names, the last embedding wins
+        if self.dtype == "int8":
+            scales = np.abs(embeddings).max(axis=1) / 127
+            scales[scales == 0] = 1.0
+            self._matrix[rows] = np.round(embeddings / scales[:, None]).astype(np.int8)
+            self._scales[rows] = scales
+        else:
+            self._matrix[rows] = embeddings
+
+    def scores(self, query_embedding: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarity between the query and every tool, as a single matrix-vector product
+        (block by block for a quantized matrix).
+        """
+        query_embedding = normalize(query_embedding)
+        if self.dtype == "float32" or self._matrix is None:
+            return self.matrix @ query_embedding
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), SCORE_BLOCK_ROWS):
+            block = slice(start, min(start + SCORE_BLOCK_ROWS, len(self)))
+            scores[block] = self._matrix[block].astype(np.float32) @ query_embedding
+        if self._scales is not None:
+            scores *= self._scales[:len(self)]
+        return scores
+
+    def score_rows(self, rows: np.ndarray, query_embedding: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarity between the (normalized) query and the tools of some rows.
+        """
+        return self.rows(rows) @ query_embedding
+
+    def search(self, query_embedding: np.ndarray, top_n: int = 5, similarity_threshold: float = 0.2) -> List[Tuple[str, float]]:
+        """
+        Find the top N tools most similar to the query.
+
+        Returns:
+            List of (tool name, similarity score) tuples above the threshold, ordered by decreasing score.
+        """
+        if len(self) == 0 or top_n <= 0:
+            return []
+        scores = self.scores(query_embedding)
+        return self._top_n(np.arange(len(self)), scores, top_n, similarity_threshold)
+
+    def _top_n(self, rows: np.ndarray, scores: np.ndarray, top_n: int, similarity_threshold: float) -> List[Tuple[str, float]]:
+        """
+        Select the top N (row, score) pairs above the threshold, ordered by decreasing score.
+        """
+        candidates = np.flatnonzero(scores >= similarity_threshold)
+        if len(candidates) > top_n:
+            # Partial sort: only the top N candidates are needed
+            candidates = candidates[np.argpartition(-scores[candidates], top_n - 1)[:top_n]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(self.names[rows[i]], float(scores[i])) for i in candidates]
+
+
+class IVFToolIndex(ToolIndex):
+    """
+    Approximate tool index for very large catalogs, based on IVF (inverted file) clustering.
+    The tools are clustered with spherical k-means and a query is only scored against the tools
+    of the n_probe clusters closest to it. Below min_size tools, the exact scan is used.
+
+    Recall/speed trade-off: more lists (n_lists) make each probed cluster smaller (faster, lower recall),
+    more probes (n_probe) score more clusters (slower, higher recall).
+    """
+    def __init__(self, n_lists: int = None, n_probe: int = 8, min_size: int = 1024, n_iter: int = 10, seed: int = 0, initial_capacity: int = 16,
+                 dtype: str = "float32"):
+        """
+        Args:
+            n_lists: Number of clusters. Defaults to about sqrt(number of tools) at training time.
+            n_probe: Number of clusters scored per query.
+            min_size: Minimum number of tools to use the approximate search (exact scan below).
+            n_iter: Number of k-means iterations.
+            seed: Random seed of the k-means initialization.
+            initial_capacity, dtype: See `ToolIndex`.
+        """
+        super().__init__(initial_capacity, dtype)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_size = min_size
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None # (n_lists, dim) normalized centroids, None until trained
+        self.recall = None # recall@5 against the exact search, measured at training time
+        self._assignments = np.zeros(0, dtype=np.int64) # row -> cluster
+        self._members: List[List[int]] = [] # cluster -> rows
+        self._member_arrays: List[np.ndarray] = [] # cached np arrays of the members, None when outdated
+        self._trained_size = 0
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def add_many(self, names: List[str], embeddings: np.ndarray):
+        """
+        Add several tool embeddings to the index.
+        The new tools are assigned to their closest cluster (incremental insertion);
+        the clusters are retrained when the index has doubled in size since the last training.
+        """
+        super().add_many(names, embeddings)
+        if len(self) < self.min_size:
+            return
+        if not self.trained or len(self) >= 2 * self._trained_size:
+            self.train()
+        else:
+            self._assign(np.unique([self._positions[name] for name in names]))
+
+    def train(self):
+        """
+        Cluster the tool embeddings with spherical k-means (on a sample for large catalogs)
+        and assign every tool to its closest cluster.
+        """
+        matrix = self.matrix
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(matrix))))
+        n_lists = min(n_lists, len(matrix))
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(len(matrix), 64 * n_lists)
+        sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=n_lists) == 0
+            sums[empty] = centroids[empty] # keep the previous centroid of empty clusters
+            centroids = normalize(sums)
+
+        self.centroids = centroids
+        self._assignments = np.full(len(matrix), -1, dtype=np.int64)
+        self._members = [[] for _ in range(n_lists)]
+        self._member_arrays = [None] * n_lists
+        self._assign(np.arange(len(matrix)))
+        self._trained_size = len(matrix)
+
+        sample_queries = matrix[rng.choice(len(matrix), min(len(matrix), 100), replace=False)]
+        self.recall = self.measure_recall(sample_queries)
+        log("info", f"IVF index trained: {len(matrix)} tools, {n_lists} lists, n_probe={self.n_probe}, recall@5={self.recall:.3f}")
+
+    def _assign(self, rows: np.ndarray):
+        """
+        Assign the given rows to their closest cluster.
+        """
+        if len(self._assignments) < len(self):
+            self._assignments = np.concatenate([self._assignments, np.full(len(self) - len(self._assignments), -1, dtype=np.int64)])
+        labels = np.argmax(self.rows(rows) @ self.centroids.T, axis=1)
+        for row, label in zip(rows.tolist(), labels.tolist()):
+            previous = self._assignments[row]
+            if previous == label:
+                continue
+            if previous >= 0: # the embedding of an existing tool was replaced
+                self._members[previous].remove(row)
+                self._member_arrays[previous] = None
+            self._members[label].append(row)
+            self._member_arrays[label] = None
+            self._assignments[row] = label
+
+    def _cluster_rows(self, cluster: int) -> np.ndarray:
+        if self._member_arrays[cluster] is None:
+            self._member_arrays[cluster] = np.asarray(self._members[cluster], dtype=np.int64)
+        return self._member_arrays[cluster]
+
+    def search(self, query_embedding: np.ndarray, top_n: int = 5, similarity_threshold: float = 0.2) -> List[Tuple[str, float]]:
+        """
+        Find the top N tools most similar to the query, scoring only the tools of the n_probe closest clusters.
+        """
+        if not self.trained or len(self) < self.min_size:
+            return super().search(query_embedding, top_n, similarity_threshold)
+        if top_n <= 0:
+            return []
+        query_embedding = normalize(query_embedding)
+        centroid_scores = self.centroids @ query_embedding
+        n_probe = min(self.n_probe, len(centroid_scores))
+        probes = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        rows = np.concatenate([self._cluster_rows(cluster) for cluster in probes])
+        scores = self.score_rows(rows, query_embedding)
+        return self._top_n(rows, scores, top_n, similarity_threshold)
+
+    def measure_recall(self, query_embeddings: np.ndarray, top_n: int = 5) -> float:
+        """
+        Measure the recall@top_n of the approximate search against the exact search.
+
+        Args:
+            query_embeddings: A (n_queries, dim) matrix of query embeddings.
+
+        Returns:
+            The average fraction of the exact top N tools found by the approximate search.
+        """
+        found = expected = 0
+        for query_embedding in np.atleast_2d(query_embeddings):
+            exact = {name for name, _ in ToolIndex.search(self, query_embedding, top_n, -np.inf)}
+            approx = {name for name, _ in self.search(query_embedding, top_n, -np.inf)}
+            found += len(exact & approx)
+            expected += len(exact)
+        return found / expected if expected else 1.0
 
 class ToolManager:
     """
     Manage all tools for the LLM. 
     It is used to select the best tools to send to the LLM for a given user query.
     """
-    def __init__(self):
-        self.tool_embeddings = {} # tool embeddings dictionary
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, cache_dir: str = None, index: ToolIndex = None, query_cache_size: int = 1024, query_cache_ttl: float = None,
+                 hybrid: bool = True, lexical_weight: float = 0.3, address_boost: float = 0.1, fast_path: bool = True):
+        """
+        Args:
+            model_name: Name of the SentenceTransformer model used for the embeddings.
+            cache_dir: Directory of the on-disk tool embedding cache. No caching if None.
+            index: The tool index. Defaults to an exact ToolIndex, use an IVFToolIndex for very large catalogs.
+            query_cache_size: Maximum number of query embeddings kept in memory.
+            query_cache_ttl: Time-to-live of the cached query embeddings in seconds (no expiry if None).
+            hybrid: Fuse the embedding similarity with the BM25 score of the lexical index. Embedding similarity only if False.
+            lexical_weight: Weight of the BM25 score (normalized by its upper bound for the query) added to the similarity.
+            address_boost: Score added to the tools that take an address when the query contains a Solana address.
+            fast_path: Skip the embedding of the query when the names of the top lexical matches are fully contained in it.
+        """
+        self.model_name = model_name
+        self.index = index if index is not None else ToolIndex() # matrix-backed index of the tool embeddings
+        self.cache = EmbeddingCache(cache_dir, model_name) if cache_dir else None
+        self.query_cache = LRUCache(max_size=query_cache_size, ttl=query_cache_ttl) # query text -> embedding
+        self.hybrid = hybrid
+        self.lexical_weight = lexical_weight
+        self.address_boost = address_boost
+        self.fast_path = fast_path
+        self.lexical_index = LexicalIndex()
+        self.address_tools: Set[str] = set() # tools with an address parameter
+
+    @property
+    def tool_embeddings(self) -> Dict[str, np.ndarray]:
+        """
+        The (normalized) tool embeddings by tool name.
+        """
+        return {name: self.index.get(name) for name in self.index.names}
 
     def store_tool_embeddings(self, tool: Dict):
         """
@@ -29,21 +556,70 @@ class ToolManager:
                         "required": ["param1"]
                     }
                 }
+        """
+        self.register_functions([tool])
 
-        Returns:
-            A dictionary where keys are function names and values are their embeddings.
+    def register_functions(self, tools: List[Dict], batch_size: int = 32):
         """
-        tool_name = tool["function"]
-        function_embedding = self.get_embedding(str(tool))
-        self.tool_embeddings[tool_name] = function_embedding # store the embedding for the tool in the tool_embeddings dictionary
+        Compute and store the embeddings of several tool descriptions at once.
+        Unchanged tools are loaded from the cache, the other ones are encoded in batches of batch_size,
+        then all the tools are inserted into the index in one step.
 
-    
-    def get_embedding(self, text, model_name="all-MiniLM-L6-v2"):
+        Args:
+            tools: A list of tool dictionaries (see `store_tool_embeddings` for the structure).
+            batch_size: Number of tool descriptions encoded per forward pass.
+        """
+        if not tools:
+            return
+        tool_names = [tool["function"] for tool in tools]
+        for tool in tools:
+            parameter_names = self._parameter_names(tool.get("parameters"))
+            self.lexical_index.add(tool["function"], tool.get("description", ""), parameter_names)
+            if any("address" in parameter_name.lower() for parameter_name in parameter_names):
+                self.address_tools.add(tool["function"])
+            else:
+                self.address_tools.discard(tool["function"])
+        cache_texts = [json.dumps(tool, sort_keys=True) for tool in tools]
+        function_embeddings = self.cache.get_many(cache_texts) if self.cache is not None else [None] * len(tools)
+
+        # Only new or edited tools are encoded
+        missing = [i for i, embedding in enumerate(function_embeddings) if embedding is None]
+        if missing:
+            encoded = self.get_embedding([str(tools[i]) for i in missing], batch_size=batch_size)
+            for i, embedding in zip(missing, encoded):
+                function_embeddings[i] = embedding
+            if self.cache is not None:
+                self.cache.put_many([cache_texts[i] for i in missing], encoded)
+                self.cache.flush()
+
+        self.index.add_many(tool_names, np.stack(function_embeddings)) # store the embeddings of the tools in the index
+
+    def _parameter_names(self, parameters) -> List[str]:
         """
-        Get the embedding for a given text using SentenceTransformer.
+        Names of the parameters of a tool, from its JSON schema ({"type": "object", "properties": {...}}).
         """
-        model = SentenceTransformer(model_name)
-        return model.encode(text)
+        if not isinstance(parameters, dict):
+            return []
+        properties = parameters.get("properties")
+        return list(properties) if isinstance(properties, dict) else []
+
+    def get_embedding(self, text, model_name=None, batch_size=32):
+        """
+        Get the embedding for a given text (or the embeddings for a list of texts) using SentenceTransformer.
+        The model is loaded once per process and shared by all the ToolManager instances.
+        """
+        model = get_model(model_name or self.model_name)
+        return model.encode(text, batch_size=batch_size)
+
+    def get_query_embedding(self, text: str) -> np.ndarray:
+        """
+        Get the embedding of a user query. Repeated queries are served from the LRU query cache.
+        """
+        def compute():
+            with span("query_embedding"):
+                return self.get_embedding(text)
+
+        return self.query_cache.get_or_set(text, compute)
     
     def select_tools(self, user_input, top_n=5, similarity_threshold=0.2):
         """
@@ -57,23 +633,60 @@ class ToolManager:
         Returns:
             List of tool names that meet the similarity threshold, ordered by relevance
         """
-        user_embedding = self.get_embedding(user_input) 
-        similarities = {}
-
         # Are there any tool embeddings?
-        if not self.tool_embeddings:
-            print("Warning: No tool embeddings found!")
+        if len(self.index) == 0:
+            log("warning", "No tool embeddings found!")
             return []
 
-        for tool_name, tool_embedding in self.tool_embeddings.items():
-            similarity = cosine_similarity([user_embedding], [tool_embedding])[0][0]
-            # Only include tools that meet the threshold
-            if similarity >= similarity_threshold:
-                similarities[tool_name] = similarity
-        
-        # Select the top N functions with the highest similarity scores
-        sorted_functions = sorted(similarities.items(), key=lambda x: x[1], reverse=True)
-        print(f"#### Sorted functions:\n {sorted_functions} \n####")
-        
-        top_n = min(top_n, len(sorted_functions))
-        return [tool for tool, score in sorted_functions[:top_n]]
+        with span("select_tools"):
+            if self.hybrid:
+                sorted_functions = self._hybrid_search(user_input, top_n, similarity_threshold)
+            else:
+                user_embedding = self.get_query_embedding(user_input)
+                sorted_functions = self.index.search(user_embedding, top_n=top_n, similarity_threshold=similarity_threshold)
+        log("debug", lambda: f"Sorted functions:\n {sorted_functions}")
+
+        return [tool for tool, score in sorted_functions]
+
+    def _hybrid_search(self, user_input: str, top_n: int, similarity_threshold: float) -> List[Tuple[str, float]]:
+        """
+        Rank the tools by embedding similarity + lexical_weight * BM25 score / LexicalIndex.max_score (+ address_boost).
+        The lexical score only adds to the similarity, so tools without keyword matches keep their embedding ranking.
+        The candidates are the top semantic matches and the top lexical matches.
+
+        Returns:
+            List of (tool name, score) tuples above the threshold, ordered by decreasing score.
+        """
+        query_terms = tokenize(user_input)
+        lexical_scores = self.lexical_index.scores(query_terms)
+        max_lexical = self.lexical_index.max_score(query_terms)
+        lexical_candidates = self.lexical_index.top(lexical_scores, max(top_n * 4, 20))
+        has_address = ADDRESS_PATTERN.search(user_input) is not None
+
+        def lexical_score(name: str) -> float:
+            if max_lexical <= 0 or name not in self.lexical_index:
+                return 0.0
+            return float(lexical_scores[self.lexical_index.position(name)]) / max_lexical
+
+        # Fast path: the names of the top lexical matches are in the query, no need to embed it
+        if self.fast_path:
+            matches = self.lexical_index.name_matches(query_terms, lexical_candidates[:top_n])
+            if matches:
+                metrics.inc("select_tools_fast_path_total")
+                return [(name, 1.0 + self.lexical_weight * lexical_score(name)) for name in matches]
+
+        query_embedding = normalize(self.get_query_embedding(user_input))
+        candidates = {name: score for name, score in self.index.search(query_embedding, top_n=max(top_n * 4, 20), similarity_threshold=-np.inf)}
+        for name in lexical_candidates:
+            if name not in candidates and name in self.index:
+                candidates[name] = float(self.index.get(name) @ query_embedding)
+
+        fused = []
+        for name, similarity in candidates.items():
+            score = similarity + self.lexical_weight * lexical_score(name)
+            if has_address and name in self.address_tools:
+                score += self.address_boost
+            if score >= similarity_threshold:
+                fused.append((name, score))
+        fused.sort(key=lambda item: (-item[1], item[0]))
+        return fused[:top_n]